@@ -0,0 +1,805 @@
+"""Замеры производительности сервера на временной базе данных.
+
+Запуск:
+    python benchmark.py pool --requests 2000
+    python benchmark.py pool --server /path/to/old/server.py
+    python benchmark.py login-scaling --sizes 1000 100000 1000000
+    python benchmark.py stats-scaling --sizes 10000 1000000 50000000
+    python benchmark.py batch --rows 20000 --batch-size 500
+    python benchmark.py concurrency --slow-ms 500
+    python benchmark.py auth --requests 5000
+    python benchmark.py login-throughput --clients 8 --requests 200
+    python benchmark.py startup --requests 500
+    python benchmark.py stream-fanout --subscribers 1000 10000
+    python benchmark.py metrics-overhead --requests 5000
+    python benchmark.py shards --shards 1 2 4 8 --writers 8 --rows 20000
+    python benchmark.py load --users 10000 --scores 1000000 --clients 50 --duration 30 \
+        --mix login=1 me=4 scores=4 leaderboard=8 user-stats=2
+    python benchmark.py workers --workers 1 2 4 --users 10000 --clients 100 --duration 30
+    python benchmark.py export --rows 50000000 --formats csv columnar
+
+Параметр --server позволяет сравнить текущую версию server.py
+с любой другой (например, из предыдущего коммита).
+"""
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+DEFAULT_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+SEED_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# Замеры меряют пропускную способность сервера, а не ограничение частоты запросов
+BENCH_ENV = {"RATE_LIMIT_SCORES_RATE": "0", "RATE_LIMIT_SCORES_BATCH_RATE": "0"}
+
+@contextmanager
+def temp_database(env=None):
+    workdir = tempfile.mkdtemp(prefix="flappy-bench-")
+    database = os.path.join(workdir, "bench.db")
+    old_env = dict(os.environ)
+    os.environ["DATABASE_FILE"] = database
+    os.environ.update(BENCH_ENV)
+    os.environ.update(env or {})
+    try:
+        yield database
+    finally:
+        os.environ.clear()
+        os.environ.update(old_env)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def load_server(server_path, database):
+    spec = importlib.util.spec_from_file_location(
+        f"bench_server_{abs(hash(database))}", server_path
+    )
+    server = importlib.util.module_from_spec(spec)
+    # Пулу процессов нужно находить функции сервера по имени модуля
+    sys.modules[spec.name] = server
+    spec.loader.exec_module(server)
+    server.DATABASE_FILE = database
+    return server
+
+@contextmanager
+def temp_server(server_path, env=None):
+    from fastapi.testclient import TestClient
+
+    with temp_database(env) as database:
+        server = load_server(server_path, database)
+        with TestClient(server.app) as client:
+            yield server, client
+
+def register_users(client, count, password="bench"):
+    tokens = []
+    for i in range(count):
+        username = f"player{i:07d}"
+        client.post("/register", json={"username": username, "password": password})
+        response = client.post("/login", json={"username": username, "password": password})
+        tokens.append(response.json()["token"])
+    return tokens
+
+def seed_users(database, count, password="bench", batch=50000):
+    hashed = hashlib.sha256(password.encode()).hexdigest()
+    created_at = "2024-01-01T00:00:00"
+    conn = sqlite3.connect(database)
+    start = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    for offset in range(start, count, batch):
+        conn.executemany(
+            "INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)",
+            ((f"player{i:07d}", hashed, created_at) for i in range(offset, min(offset + batch, count))),
+        )
+        conn.commit()
+    conn.close()
+
+def seed_scores(database, users, count, seed=42, batch=100000):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(database)
+    start = conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+    for offset in range(start, count, batch):
+        conn.executemany(
+            "INSERT INTO scores (user_id, score, created_at) VALUES (?, ?, ?)",
+            (
+                (rng.randint(1, users), rng.randint(0, 200), (SEED_EPOCH + timedelta(seconds=i)).isoformat())
+                for i in range(offset, min(offset + batch, count))
+            ),
+        )
+        conn.commit()
+    conn.close()
+
+def measure(func, count):
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return latency_summary(samples)
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    return {
+        "requests": len(samples),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+    }
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+def timed(func, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": count,
+        "seconds": round(elapsed, 4),
+        "req_per_s": round(count / elapsed, 1),
+    }
+
+def bench_pool(args):
+    with temp_server(args.server) as (server, client):
+        rng = random.Random(args.seed)
+        tokens = register_users(client, args.users)
+        for _ in range(args.scores):
+            client.post("/scores", json={"score": rng.randint(0, 100)},
+                        headers=auth(rng.choice(tokens)))
+
+        results = {
+            "POST /login": timed(
+                lambda: client.post("/login", json={"username": "player0000000", "password": "bench"}),
+                args.requests,
+            ),
+            "GET /me": timed(lambda: client.get("/me", headers=auth(tokens[0])), args.requests),
+            "POST /scores": timed(
+                lambda: client.post("/scores", json={"score": rng.randint(0, 100)},
+                                    headers=auth(rng.choice(tokens))),
+                args.requests,
+            ),
+            "GET /leaderboard": timed(lambda: client.get("/leaderboard"), args.requests),
+            "GET /user-stats": timed(lambda: client.get("/user-stats"), args.requests),
+        }
+    return {"server": args.server, "results": results}
+
+def bench_login_scaling(args):
+    results = {}
+    for size in args.sizes:
+        with temp_server(args.server) as (server, client):
+            # Первая регистрация создаёт таблицы и в старых версиях сервера
+            client.post("/register", json={"username": "player0000000", "password": "bench"})
+            seed_users(server.DATABASE_FILE, size)
+            rng = random.Random(args.seed)
+            samples = []
+            for _ in range(args.requests):
+                username = f"player{rng.randrange(size):07d}"
+                started = time.perf_counter()
+                response = client.post("/login", json={"username": username, "password": "bench"})
+                samples.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.text
+            results[str(size)] = latency_summary(samples)
+    return {"server": args.server, "login_latency": results}
+
+def bench_stats_scaling(args):
+    results = {}
+    with temp_server(args.server) as (server, client):
+        client.post("/register", json={"username": "player0000000", "password": "bench"})
+        seed_users(server.DATABASE_FILE, args.users)
+        for size in sorted(args.sizes):
+            seed_scores(server.DATABASE_FILE, args.users, size, seed=args.seed + size)
+            # Сервер с материализованными агрегатами пересобирает их по вставленной истории
+            if hasattr(server, "rebuild_aggregates"):
+                with server.pool.connection() as conn:
+                    server.rebuild_aggregates(conn)
+                    conn.commit()
+            results[str(size)] = measure(lambda: client.get("/user-stats"), args.requests)
+    return {"server": args.server, "players": args.users, "user_stats_latency": results}
+
+def bench_batch(args):
+    with temp_server(args.server) as (server, client):
+        token = register_users(client, 1)[0]
+        rng = random.Random(args.seed)
+
+        started = time.perf_counter()
+        for _ in range(args.rows):
+            client.post("/scores", json={"score": rng.randint(0, 100)}, headers=auth(token))
+        single = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for offset in range(0, args.rows, args.batch_size):
+            batch = [{"score": rng.randint(0, 100)} for _ in range(min(args.batch_size, args.rows - offset))]
+            response = client.post("/scores/batch", json=batch, headers=auth(token))
+            assert response.status_code == 200, response.text
+        batched = time.perf_counter() - started
+
+    return {
+        "server": args.server,
+        "rows": args.rows,
+        "POST /scores": {"seconds": round(single, 4), "rows_per_s": round(args.rows / single, 1)},
+        "POST /scores/batch": {
+            "batch_size": args.batch_size,
+            "seconds": round(batched, 4),
+            "rows_per_s": round(args.rows / batched, 1),
+        },
+    }
+
+def bench_concurrency(args):
+    import httpx
+
+    # ASGITransport работает без сетевого ввода-вывода, поэтому клиенты
+    # явно уступают цикл событий друг другу между запросами
+    async def submit_scores(client, token, count):
+        samples = []
+        for i in range(count):
+            started = time.perf_counter()
+            await asyncio.sleep(0)
+            response = await client.post("/scores", json={"score": i % 100}, headers=auth(token))
+            samples.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.text
+        return samples
+
+    async def run(server):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.post("/register", json={"username": "player0000000", "password": "bench"})
+            response = await client.post("/login", json={"username": "player0000000", "password": "bench"})
+            token = response.json()["token"]
+
+            idle = await submit_scores(client, token, args.requests)
+
+            stop = asyncio.Event()
+            async def slow_stats():
+                while not stop.is_set():
+                    await client.get("/user-stats")
+                    await asyncio.sleep(0)
+            loaders = [asyncio.create_task(slow_stats()) for _ in range(args.slow_clients)]
+            await asyncio.sleep(0.01)
+            loaded = await submit_scores(client, token, args.requests)
+            stop.set()
+            await asyncio.gather(*loaders)
+        return idle, loaded
+
+    with temp_database() as database:
+        server = load_server(args.server, database)
+        # Намеренно медленный запрос статистики
+        original = server.fetch_user_stats_page
+        def slow_page(*page_args):
+            time.sleep(args.slow_ms / 1000)
+            return original(*page_args)
+        server.fetch_user_stats_page = slow_page
+
+        server.startup()
+        try:
+            idle, loaded = asyncio.run(run(server))
+        finally:
+            server.shutdown()
+
+    return {
+        "server": args.server,
+        "slow_stats_ms": args.slow_ms,
+        "slow_stats_clients": args.slow_clients,
+        "POST /scores idle": latency_summary(idle),
+        "POST /scores with slow /user-stats": latency_summary(loaded),
+    }
+
+def bench_auth(args):
+    with temp_server(args.server) as (server, client):
+        token = register_users(client, 1)[0]
+
+        # Проверка токена сама по себе: кэш проверенных токенов или полный разбор JWT
+        if hasattr(server, "authenticate"):
+            async def check_all():
+                for _ in range(args.requests):
+                    await server.authenticate(token)
+            started = time.perf_counter()
+            asyncio.run(check_all())
+        else:
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                server.verify_token(token)
+        per_check = (time.perf_counter() - started) / args.requests
+
+        me = measure(lambda: client.get("/me", headers=auth(token)), args.requests)
+    return {
+        "server": args.server,
+        "token_check_us": round(per_check * 1e6, 2),
+        "GET /me": me,
+    }
+
+def bench_login_throughput(args):
+    import httpx
+
+    # Параллельные входы: хеширование паролей не должно блокировать цикл событий
+    async def login(client, count):
+        for _ in range(count):
+            response = await client.post(
+                "/login", json={"username": "player0000000", "password": "bench"}
+            )
+            assert response.status_code == 200, response.text
+
+    async def run(server):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.post("/register", json={"username": "player0000000", "password": "bench"})
+            per_client = max(1, args.requests // args.clients)
+            started = time.perf_counter()
+            await asyncio.gather(*(login(client, per_client) for _ in range(args.clients)))
+            return per_client * args.clients, time.perf_counter() - started
+
+    with temp_database() as database:
+        server = load_server(args.server, database)
+        server.startup()
+        try:
+            logins, elapsed = asyncio.run(run(server))
+        finally:
+            server.shutdown()
+
+    return {
+        "server": args.server,
+        "cpus": os.cpu_count(),
+        "clients": args.clients,
+        "logins": logins,
+        "seconds": round(elapsed, 3),
+        "logins_per_s": round(logins / elapsed, 1),
+    }
+
+def bench_startup(args):
+    from fastapi.testclient import TestClient
+
+    env = {"PASSWORD_HASH_ITERATIONS": str(args.hash_iterations)}
+    starts = {}
+    with temp_database(env) as database:
+        # Первый запуск создаёт схему, повторные находят её готовой
+        for attempt in ("cold start (empty database)", "restart (existing database)"):
+            server = load_server(args.server, database)
+            started = time.perf_counter()
+            with TestClient(server.app) as client:
+                client.get("/leaderboard")
+                starts[attempt] = round((time.perf_counter() - started) * 1000, 3)
+                if attempt.startswith("restart"):
+                    counter = iter(range(args.requests))
+                    register = measure(
+                        lambda: client.post(
+                            "/register", json={"username": f"player{next(counter):07d}", "password": "bench"}
+                        ),
+                        args.requests,
+                    )
+    return {"server": args.server, "startup_ms": starts, "POST /register": register}
+
+def bench_stream_fanout(args):
+    import tracemalloc
+
+    # Подписчики /leaderboard/stream без сети: задача на каждого, как у открытого потока
+    async def run(server, count, round_):
+        received = 0
+        done = asyncio.Event()
+
+        async def subscriber(queue):
+            nonlocal received
+            await queue.get()
+            received += 1
+            if received == count:
+                done.set()
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        queues = [server.leaderboard_stream.subscribe() for _ in range(count)]
+        for queue in queues:
+            queue.get_nowait()
+        tasks = [asyncio.create_task(subscriber(queue)) for queue in queues]
+        await asyncio.sleep(0)
+        per_subscriber = (tracemalloc.get_traced_memory()[0] - before) / count
+        tracemalloc.stop()
+
+        started = time.perf_counter()
+        server.leaderboard.record(1, "player0000000", 1000 + round_)
+        server.leaderboard_stream.notify()
+        await done.wait()
+        elapsed = time.perf_counter() - started
+
+        for queue in queues:
+            server.leaderboard_stream.unsubscribe(queue)
+        await asyncio.gather(*tasks)
+        return per_subscriber, elapsed
+
+    results = {}
+    with temp_server(args.server) as (server, client):
+        register_users(client, 1)
+        for round_, count in enumerate(args.subscribers):
+            per_subscriber, elapsed = asyncio.run(run(server, count, round_))
+            results[str(count)] = {
+                "fanout_ms": round(elapsed * 1000, 3),
+                "per_subscriber_us": round(elapsed / count * 1e6, 3),
+                "memory_per_subscriber_bytes": round(per_subscriber),
+            }
+    return {"server": args.server, "subscribers": results}
+
+def bench_metrics_overhead(args):
+    results = {}
+    for enabled in ("0", "1"):
+        with temp_server(args.server, {"METRICS_ENABLED": enabled}) as (server, client):
+            token = register_users(client, 1)[0]
+            client.post("/scores", json={"score": 1}, headers=auth(token))
+            results["metrics on" if enabled == "1" else "metrics off"] = {
+                "GET /leaderboard": measure(lambda: client.get("/leaderboard"), args.requests),
+                "GET /me": measure(lambda: client.get("/me", headers=auth(token)), args.requests),
+                "GET /user-stats": measure(lambda: client.get("/user-stats"), args.requests),
+            }
+    return {"server": args.server, "results": results}
+
+def bench_shards(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Параллельные писатели вставляют результаты напрямую через write_scores:
+    # замеряется только хранилище, без HTTP
+    def writer(server, index, count):
+        rng = random.Random(args.seed + index)
+        for i in range(count):
+            user_id = 1 + (index + i * args.writers) % args.users
+            created_at = (SEED_EPOCH + timedelta(seconds=i)).isoformat()
+            server.write_scores(user_id, [(rng.randint(0, 200), created_at)])
+
+    results = {}
+    for shards in args.shards:
+        env = {"SCORE_SHARDS": str(shards), "DB_SYNCHRONOUS": args.synchronous}
+        with temp_database(env) as database:
+            server = load_server(args.server, database)
+            server.init_database()
+            seed_users(database, args.users)
+            per_writer = args.rows // args.writers
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.writers) as executor:
+                list(executor.map(lambda index: writer(server, index, per_writer), range(args.writers)))
+            elapsed = time.perf_counter() - started
+            server.shutdown()
+        rows = per_writer * args.writers
+        results[str(shards)] = {
+            "rows": rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_s": round(rows / elapsed, 1),
+        }
+    return {
+        "server": args.server,
+        "writers": args.writers,
+        "synchronous": args.synchronous,
+        "cpus": os.cpu_count(),
+        "insert_throughput": results,
+    }
+
+LOAD_ENDPOINTS = {
+    "login": lambda rng, users, token: (
+        "POST", "/login",
+        {"json": {"username": f"player{rng.randrange(users):07d}", "password": "bench"}},
+    ),
+    "me": lambda rng, users, token: ("GET", "/me", {"headers": auth(token)}),
+    "scores": lambda rng, users, token: (
+        "POST", "/scores", {"json": {"score": rng.randint(0, 200)}, "headers": auth(token)},
+    ),
+    "leaderboard": lambda rng, users, token: ("GET", "/leaderboard", {}),
+    "user-stats": lambda rng, users, token: ("GET", "/user-stats", {}),
+}
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        name, _, weight = item.partition("=")
+        if name not in LOAD_ENDPOINTS:
+            raise SystemExit(f"unknown endpoint in --mix: {name} (known: {', '.join(LOAD_ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+def prepare_database(server_path, database, users, scores, seed):
+    # Схема создаётся самим сервером, данные заливаются напрямую в SQLite
+    server = load_server(server_path, database)
+    if hasattr(server, "init_database"):
+        server.init_database()
+        server.shutdown()
+    else:
+        server.create_tables()
+    seed_users(database, users)
+    seed_scores(database, users, scores, seed=seed)
+    if hasattr(server, "rebuild_aggregates"):
+        server.init_database()
+        with server.pool.connection() as conn:
+            server.rebuild_aggregates(conn)
+            conn.commit()
+        server.shutdown()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@contextmanager
+def uvicorn_server(server_path, database, port, workers=1):
+    # Сервер запускается во временном каталоге базы: база берётся из DATABASE_FILE,
+    # а относительные пути не задевают рабочие файлы
+    app_dir, filename = os.path.split(os.path.abspath(server_path))
+    command = [sys.executable, "-m", "uvicorn", f"{os.path.splitext(filename)[0]}:app",
+               "--app-dir", app_dir, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    if workers > 1:
+        command += ["--workers", str(workers)]
+    process = subprocess.Popen(
+        command,
+        cwd=os.path.dirname(database),
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield process
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+async def wait_until_ready(client, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"server exited with code {process.returncode}")
+        try:
+            await client.get("/leaderboard")
+            return
+        except Exception:
+            await asyncio.sleep(0.2)
+    raise SystemExit("server did not start in time")
+
+def bench_load(args):
+    import httpx
+
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+
+    async def worker(client, index, token, deadline, samples, errors):
+        rng = random.Random(args.seed + index)
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            method, path, kwargs = LOAD_ENDPOINTS[name](rng, args.users, token)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            samples[name].append(time.perf_counter() - started)
+            if not ok:
+                errors[name] = errors.get(name, 0) + 1
+
+    async def run(process, port):
+        limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=args.timeout
+        ) as client:
+            await wait_until_ready(client, process)
+            # Токены получаем заранее, эти входы в замер не попадают
+            tokens = []
+            for index in range(args.clients):
+                response = await client.post(
+                    "/login", json={"username": f"player{index % args.users:07d}", "password": "bench"}
+                )
+                tokens.append(response.json()["token"])
+
+            samples = {name: [] for name in names}
+            errors = {}
+            started = time.perf_counter()
+            deadline = time.monotonic() + args.duration
+            await asyncio.gather(*(
+                worker(client, index, token, deadline, samples, errors)
+                for index, token in enumerate(tokens)
+            ))
+            return samples, errors, time.perf_counter() - started
+
+    env = {"PASSWORD_HASH_ITERATIONS": str(args.hash_iterations), "SERVER_WORKERS": str(args.workers)}
+    with temp_database(env) as database:
+        prepare_database(args.server, database, args.users, args.scores, args.seed)
+        port = free_port()
+        with uvicorn_server(args.server, database, port, args.workers) as process:
+            samples, errors, elapsed = asyncio.run(run(process, port))
+
+    endpoints = {}
+    for name in names:
+        if samples[name]:
+            endpoints[name] = dict(
+                latency_summary(samples[name]),
+                errors=errors.get(name, 0),
+                req_per_s=round(len(samples[name]) / elapsed, 1),
+            )
+    total = sum(len(values) for values in samples.values())
+    return {
+        "server": args.server,
+        "config": {
+            "users": args.users,
+            "scores": args.scores,
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "mix": mix,
+            "hash_iterations": args.hash_iterations,
+            "workers": args.workers,
+            "seed": args.seed,
+            "cpus": os.cpu_count(),
+        },
+        "total": {
+            "requests": total,
+            "errors": sum(errors.values()),
+            "seconds": round(elapsed, 3),
+            "req_per_s": round(total / elapsed, 1),
+        },
+        "endpoints": endpoints,
+    }
+
+def bench_workers(args):
+    # Одна и та же смесь нагрузки на 1..N процессах uvicorn поверх общей базы
+    results = {}
+    for workers in args.worker_counts:
+        report = bench_load(argparse.Namespace(**vars(args), workers=workers))
+        results[str(workers)] = dict(report["total"], endpoints={
+            name: {"p50_ms": stats["p50_ms"], "p99_ms": stats["p99_ms"], "req_per_s": stats["req_per_s"]}
+            for name, stats in report["endpoints"].items()
+        })
+    return {
+        "server": args.server,
+        "config": {key: value for key, value in report["config"].items() if key != "workers"},
+        "workers": results,
+    }
+
+def bench_export(args):
+    # Выгрузка через генератор export_scores (то же, что отдаёт /admin/export) без HTTP
+    import resource
+
+    def max_rss_mb():
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    results = {}
+    with temp_server(args.server) as (server, client):
+        client.post("/register", json={"username": "player0000000", "password": "bench"})
+        seed_users(server.DATABASE_FILE, args.users)
+        started = time.perf_counter()
+        seed_scores(server.DATABASE_FILE, args.users, args.rows, seed=args.seed)
+        seeded = time.perf_counter() - started
+        rss_before = max_rss_mb()
+
+        for format in args.formats:
+            size = 0
+            started = time.perf_counter()
+            for block in server.export_scores(format):
+                size += len(block)
+            elapsed = time.perf_counter() - started
+            results[format] = {
+                "seconds": round(elapsed, 2),
+                "rows_per_s": round(args.rows / elapsed),
+                "megabytes": round(size / 2 ** 20, 1),
+                "megabytes_per_s": round(size / 2 ** 20 / elapsed, 1),
+                "max_rss_mb": max_rss_mb(),
+            }
+    return {
+        "server": args.server,
+        "rows": args.rows,
+        "seed_seconds": round(seeded, 1),
+        "max_rss_mb_before_export": rss_before,
+        "export": results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flappy server benchmarks")
+    parser.add_argument("--server", default=DEFAULT_SERVER, help="path to server.py under test")
+    parser.add_argument("--seed", type=int, default=42)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pool_parser = commands.add_parser("pool", help="req/s per endpoint (connection handling)")
+    pool_parser.add_argument("--users", type=int, default=50)
+    pool_parser.add_argument("--scores", type=int, default=1000)
+    pool_parser.add_argument("--requests", type=int, default=1000)
+    pool_parser.set_defaults(func=bench_pool)
+
+    login_parser = commands.add_parser("login-scaling", help="/login latency vs number of accounts")
+    login_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    login_parser.add_argument("--requests", type=int, default=200)
+    login_parser.set_defaults(func=bench_login_scaling)
+
+    stats_parser = commands.add_parser("stats-scaling", help="/user-stats latency vs size of scores")
+    stats_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000, 50000000])
+    stats_parser.add_argument("--users", type=int, default=1000)
+    stats_parser.add_argument("--requests", type=int, default=50)
+    stats_parser.set_defaults(func=bench_stats_scaling)
+
+    batch_parser = commands.add_parser("batch", help="rows/s: single-score vs batch ingestion")
+    batch_parser.add_argument("--rows", type=int, default=20000)
+    batch_parser.add_argument("--batch-size", type=int, default=500)
+    batch_parser.set_defaults(func=bench_batch)
+
+    concurrency_parser = commands.add_parser(
+        "concurrency", help="/scores latency while slow /user-stats requests are in flight"
+    )
+    concurrency_parser.add_argument("--slow-ms", type=int, default=500)
+    concurrency_parser.add_argument("--slow-clients", type=int, default=2)
+    concurrency_parser.add_argument("--requests", type=int, default=200)
+    concurrency_parser.set_defaults(func=bench_concurrency)
+
+    auth_parser = commands.add_parser("auth", help="per-request cost of token verification")
+    auth_parser.add_argument("--requests", type=int, default=5000)
+    auth_parser.set_defaults(func=bench_auth)
+
+    throughput_parser = commands.add_parser(
+        "login-throughput", help="/login per second with concurrent clients"
+    )
+    throughput_parser.add_argument("--clients", type=int, default=8)
+    throughput_parser.add_argument("--requests", type=int, default=200)
+    throughput_parser.set_defaults(func=bench_login_throughput)
+
+    startup_parser = commands.add_parser("startup", help="cold-start time and /register latency")
+    startup_parser.add_argument("--requests", type=int, default=500)
+    startup_parser.add_argument("--hash-iterations", type=int, default=1000)
+    startup_parser.set_defaults(func=bench_startup)
+
+    fanout_parser = commands.add_parser(
+        "stream-fanout", help="/leaderboard/stream: time and memory to push one change"
+    )
+    fanout_parser.add_argument("--subscribers", type=int, nargs="+", default=[1000, 10000])
+    fanout_parser.set_defaults(func=bench_stream_fanout)
+
+    metrics_parser = commands.add_parser(
+        "metrics-overhead", help="request latency with METRICS_ENABLED=0 and =1"
+    )
+    metrics_parser.add_argument("--requests", type=int, default=5000)
+    metrics_parser.set_defaults(func=bench_metrics_overhead)
+
+    shards_parser = commands.add_parser("shards", help="score insert throughput vs SCORE_SHARDS")
+    shards_parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    shards_parser.add_argument("--writers", type=int, default=8)
+    shards_parser.add_argument("--rows", type=int, default=20000)
+    shards_parser.add_argument("--users", type=int, default=1000)
+    shards_parser.add_argument("--synchronous", default="NORMAL", choices=["OFF", "NORMAL", "FULL"])
+    shards_parser.set_defaults(func=bench_shards)
+
+    def add_load_arguments(load_parser):
+        load_parser.add_argument("--users", type=int, default=1000)
+        load_parser.add_argument("--scores", type=int, default=100000)
+        load_parser.add_argument("--clients", type=int, default=50)
+        load_parser.add_argument("--duration", type=float, default=20)
+        load_parser.add_argument("--timeout", type=float, default=30)
+        load_parser.add_argument(
+            "--mix", nargs="+", default=["login=1", "me=4", "scores=4", "leaderboard=8", "user-stats=2"],
+            help="endpoint=weight pairs; endpoints: " + ", ".join(LOAD_ENDPOINTS),
+        )
+        load_parser.add_argument("--hash-iterations", type=int, default=100000)
+
+    load_parser = commands.add_parser(
+        "load", help="load test of a uvicorn server on localhost with a mix of endpoints"
+    )
+    add_load_arguments(load_parser)
+    load_parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    load_parser.set_defaults(func=bench_load)
+
+    workers_parser = commands.add_parser("workers", help="load test throughput vs uvicorn worker count")
+    add_load_arguments(workers_parser)
+    workers_parser.add_argument("--workers", dest="worker_counts", type=int, nargs="+", default=[1, 2, 4])
+    workers_parser.set_defaults(func=bench_workers)
+
+    export_parser = commands.add_parser("export", help="/admin/export rows/s for csv and columnar")
+    export_parser.add_argument("--rows", type=int, default=1000000)
+    export_parser.add_argument("--users", type=int, default=10000)
+    export_parser.add_argument("--formats", nargs="+", default=["csv", "columnar"], choices=["csv", "columnar"])
+    export_parser.set_defaults(func=bench_export)
+
+    args = parser.parse_args(argv)
+    json.dump(args.func(args), sys.stdout, indent=2, ensure_ascii=False)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import tkinter as tk
 from tkinter import messagebox
 import threading
 import requests
+import json
 import random
 import pygame
 import sys
@@ -47,15 +48,74 @@ class FlappyBird:
         self.offset = random.randint(-110, 110)
         self.show_leaderboard = False
         self.leaderboard_data = []
+        self.leaderboard_etag = None
+        self.stats_etag = None
+        self.stats_players = []
+        # Пока открыт /leaderboard/stream, таблица обновляется сервером сама
+        self.leaderboard_live = False
+        self.leaderboard_stop = threading.Event()
+        self.leaderboard_response = None
+        threading.Thread(target=self.follow_leaderboard, daemon=True).start()
         self.update_leaderboard()
         self.reset_game()
 
+    def follow_leaderboard(self):
+        # Server-Sent Events: снимок топа, затем только изменившиеся позиции
+        delay = 1
+        while not self.leaderboard_stop.is_set():
+            try:
+                response = requests.get(
+                    "http://127.0.0.1:8001/leaderboard/stream", stream=True, timeout=(5, 60)
+                )
+                self.leaderboard_response = response
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if self.leaderboard_stop.is_set():
+                        break
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        self.apply_leaderboard_event(event, json.loads(line[5:]))
+                        delay = 1
+            except (requests.RequestException, ValueError, AttributeError):
+                pass
+            self.leaderboard_live = False
+            self.leaderboard_stop.wait(delay)
+            delay = min(delay * 2, 30)
+
+    def apply_leaderboard_event(self, event, data):
+        if event == "snapshot":
+            self.leaderboard_data = data["leaderboard"]
+            self.leaderboard_live = True
+        elif event == "diff":
+            leaderboard = self.leaderboard_data[:data["size"]]
+            for item in data["changes"]:
+                if item["position"] > len(leaderboard):
+                    leaderboard.append(item)
+                else:
+                    leaderboard[item["position"] - 1] = item
+            # Подменяем список целиком: draw_leaderboard не увидит его наполовину обновлённым
+            self.leaderboard_data = leaderboard
+
+    def stop_leaderboard(self):
+        self.leaderboard_stop.set()
+        if self.leaderboard_response is not None:
+            self.leaderboard_response.close()
+
     def update_leaderboard(self):
+        if self.leaderboard_live:
+            return
+        # Сервер отвечает 304, если таблица не менялась - тогда оставляем сохранённую
+        headers = {"If-None-Match": self.leaderboard_etag} if self.leaderboard_etag else {}
         try:
-            response = requests.get("http://127.0.0.1:8001/leaderboard")
+            response = requests.get("http://127.0.0.1:8001/leaderboard", headers=headers)
+            if response.status_code == 304:
+                return
             self.leaderboard_data = response.json()
+            self.leaderboard_etag = response.headers.get("ETag")
         except requests.RequestException:
             self.leaderboard_data = []
+            self.leaderboard_etag = None
 
     def save_score(self):
         try:
@@ -72,15 +132,31 @@ class FlappyBird:
                 "score": self.counter,
                 "timestamp": int(time.time())
             }
+            self.post_score(data, headers)
+            
+        except requests.RequestException as e:
+            print(f"Error saving score: {e}")
+
+    def post_score(self, data, headers, attempt=0):
+        try:
             response = requests.post(
                 "http://127.0.0.1:8001/scores",
                 json=data,
                 headers=headers
             )
-            
-            if response.status_code != 200:
+
+            # 429/503: сервер просит повторить позже - ждём Retry-After в фоне,
+            # не останавливая игру
+            retry_after = response.headers.get("Retry-After")
+            if response.status_code in (429, 503) and retry_after and attempt < 3:
+                timer = threading.Timer(
+                    float(retry_after), self.post_score, args=(data, headers, attempt + 1)
+                )
+                timer.daemon = True
+                timer.start()
+            elif response.status_code != 200:
                 print(f"Error saving score: {response.json()}")
-            
+
         except requests.RequestException as e:
             print(f"Error saving score: {e}")
 
@@ -183,9 +259,11 @@ class FlappyBird:
             if result == "restart":
                 continue  # Теперь continue находится в правильном месте
             elif result == "profile":
+                self.stop_leaderboard()
                 pygame.quit()
                 return "profile"
             else:
+                self.stop_leaderboard()
                 pygame.quit()
                 return "quit"
 
@@ -431,14 +509,23 @@ class FlappyBird:
     def show_statistics(self):
         try:
             headers = {"Authorization": f"Bearer {self.token}"}
+            if self.stats_etag:
+                headers["If-None-Match"] = self.stats_etag
+            # Построчная (NDJSON) выдача: сервер не собирает весь список в памяти
             response = requests.get(
                 "http://127.0.0.1:8001/user-stats",
-                headers=headers
+                params={"format": "ndjson"},
+                headers=headers,
+                stream=True
             )
             
-            if response.status_code == 200:
-                data = response.json()
-                if not data["players"]:
+            if response.status_code in (200, 304):
+                # 304 - статистика не менялась, используем сохранённый список
+                if response.status_code == 200:
+                    self.stats_players = [json.loads(line) for line in response.iter_lines() if line]
+                    self.stats_etag = response.headers.get("ETag")
+                players = self.stats_players
+                if not players:
                     stats_text = "Нет данных о играх"
                 else:
                     stats_text = "Статистика игроков:\n"
@@ -448,9 +535,8 @@ class FlappyBird:
                     
                     total_games = 0
                     global_best = 0
-                    all_scores = []
                     
-                    for player in data["players"]:
+                    for player in players:
                         last_scores = player.get('last_scores', [])
                         last_scores_str = ", ".join(map(str, last_scores[:5]))
                         if not last_scores_str:
@@ -464,18 +550,22 @@ class FlappyBird:
                         
                         total_games += player['games_played']
                         global_best = max(global_best, player['best_score'])
-                        if player.get('last_scores'):
-                            all_scores.extend(player['last_scores'])
                     
                     stats_text += "\nОбщая статистика:\n"
                     stats_text += "-" * 30 + "\n"
                     stats_text += f"Всего игр: {total_games}\n"
                     stats_text += f"Лучший результат: {global_best}\n"
-                    if all_scores:
-                        global_average = sum(all_scores) / len(all_scores)
-                        stats_text += f"Средний результат: {global_average:.1f}\n"
+                    # Среднее и медиана по всем играм, а не только по последним пяти
+                    distribution = requests.get(
+                        "http://127.0.0.1:8001/scores/distribution",
+                        params={"percentiles": "50"}
+                    )
+                    if distribution.status_code == 200:
+                        games = distribution.json()["games"]
+                        stats_text += f"Средний результат: {games['average']:.1f}\n"
+                        stats_text += f"Медиана: {games['percentiles']['p50'] or 0}\n"
                     else:
-                        stats_text += "Средний результат: 0\n"
+                        stats_text += "Средний результат: нет данных\n"
             else:
                 stats_text = "Не удалось загрузить статистику"
             
@@ -816,6 +906,8 @@ class ProfileWindow:
     def __init__(self, token, username):
         self.token = token
         self.username = username
+        self.stats_etag = None
+        self.stats_players = []
         
         self.root = tk.Tk()
         self.root.title("Flappy Bird - Личный кабинет")
@@ -979,6 +1071,8 @@ class ProfileWindow:
                 )
                 
                 if response.status_code == 200:
+                    # Смена пароля отзывает старый токен
+                    self.token = response.json().get("token", self.token)
                     messagebox.showinfo("Успех", "Пароль успешно изменен")
                     change_window.destroy()
                 elif response.status_code == 400:
@@ -1005,14 +1099,23 @@ class ProfileWindow:
     def show_statistics(self):
         try:
             headers = {"Authorization": f"Bearer {self.token}"}
+            if self.stats_etag:
+                headers["If-None-Match"] = self.stats_etag
+            # Построчная (NDJSON) выдача: сервер не собирает весь список в памяти
             response = requests.get(
                 "http://127.0.0.1:8001/user-stats",
-                headers=headers
+                params={"format": "ndjson"},
+                headers=headers,
+                stream=True
             )
             
-            if response.status_code == 200:
-                data = response.json()
-                if not data["players"]:
+            if response.status_code in (200, 304):
+                # 304 - статистика не менялась, используем сохранённый список
+                if response.status_code == 200:
+                    self.stats_players = [json.loads(line) for line in response.iter_lines() if line]
+                    self.stats_etag = response.headers.get("ETag")
+                players = self.stats_players
+                if not players:
                     stats_text = "Нет данных о играх"
                 else:
                     stats_text = "Статистика игроков:\n"
@@ -1022,9 +1125,8 @@ class ProfileWindow:
                     
                     total_games = 0
                     global_best = 0
-                    all_scores = []
                     
-                    for player in data["players"]:
+                    for player in players:
                         last_scores = player.get('last_scores', [])
                         last_scores_str = ", ".join(map(str, last_scores[:5]))
                         if not last_scores_str:
@@ -1038,18 +1140,22 @@ class ProfileWindow:
                         
                         total_games += player['games_played']
                         global_best = max(global_best, player['best_score'])
-                        if player.get('last_scores'):
-                            all_scores.extend(player['last_scores'])
                     
                     stats_text += "\nОбщая статистика:\n"
                     stats_text += "-" * 30 + "\n"
                     stats_text += f"Всего игр: {total_games}\n"
                     stats_text += f"Лучший результат: {global_best}\n"
-                    if all_scores:
-                        global_average = sum(all_scores) / len(all_scores)
-                        stats_text += f"Средний результат: {global_average:.1f}\n"
+                    # Среднее и медиана по всем играм, а не только по последним пяти
+                    distribution = requests.get(
+                        "http://127.0.0.1:8001/scores/distribution",
+                        params={"percentiles": "50"}
+                    )
+                    if distribution.status_code == 200:
+                        games = distribution.json()["games"]
+                        stats_text += f"Средний результат: {games['average']:.1f}\n"
+                        stats_text += f"Медиана: {games['percentiles']['p50'] or 0}\n"
                     else:
-                        stats_text += "Средний результат: 0\n"
+                        stats_text += "Средний результат: нет данных\n"
             else:
                 stats_text = "Не удалось загрузить статистику"
             
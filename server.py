@@ -1,11 +1,45 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Body, status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Match
+from pydantic import BaseModel, ValidationError
 from datetime import datetime, timedelta, timezone
 import jwt
+import base64
+import csv
+import gzip
 import hashlib
-from typing import Optional
+import heapq
+import hmac
+import io
+import json
+import math
+import struct
+import sys
+from typing import Any, List, Optional
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice, takewhile
+import asyncio
+import multiprocessing
+import os
+import queue
 import sqlite3
+import threading
+import time
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    SortedList = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = FastAPI()
 
@@ -20,7 +54,130 @@ app.add_middleware(
 
 SECRET_KEY = "your_secret_key_here"
 ALGORITHM = "HS256"
-DATABASE_FILE = "my_database.db"
+TOKEN_LIFETIME = timedelta(hours=24)
+# Сколько проверенных токенов держать в памяти
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+
+# Число процессов uvicorn (serve --workers). При > 1 кэши процессов согласуются через
+# таблицу cache_events: PRAGMA data_version проверяется раз в CACHE_SYNC_INTERVAL секунд,
+# события хранятся CACHE_EVENT_TTL секунд
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "1"))
+CACHE_SYNC_INTERVAL = float(os.environ.get("CACHE_SYNC_INTERVAL", "0.1"))
+CACHE_EVENT_TTL = float(os.environ.get("CACHE_EVENT_TTL", "300"))
+
+# Хэширование паролей (PBKDF2-SHA256) в пуле процессов; ядра делятся между процессами сервера
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", "100000"))
+PASSWORD_HASH_WORKERS = int(os.environ.get(
+    "PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // SERVER_WORKERS))
+))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "64"))
+DATABASE_FILE = os.environ.get("DATABASE_FILE", "my_database.db")
+# Число файлов-шардов для результатов (scores и user_aggregates), игрок живёт
+# в шарде user_id % SCORE_SHARDS; 1 - всё в DATABASE_FILE
+SCORE_SHARDS = int(os.environ.get("SCORE_SHARDS", "1"))
+# Экспорт подключает все шарды к одному соединению (ATTACH), а SQLite по умолчанию
+# разрешает не больше 10 подключённых баз
+SCORE_SHARDS_MAX = 10
+
+# Параметры пула соединений с SQLite
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))
+DB_HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_HEALTH_CHECK_INTERVAL", "30"))
+# Запросы к базе выполняются вне цикла событий, в отдельном пуле потоков
+DB_MAX_WORKERS = int(os.environ.get("DB_MAX_WORKERS", str(DB_POOL_SIZE)))
+DB_QUERY_TIMEOUT = float(os.environ.get("DB_QUERY_TIMEOUT", "10"))
+DB_PRAGMAS = {
+    # Действует для новых файлов; существующий переводится командой "vacuum"
+    "auto_vacuum": os.environ.get("DB_AUTO_VACUUM", "INCREMENTAL"),
+    "journal_mode": os.environ.get("DB_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("DB_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # Отрицательное значение - размер кэша в КиБ
+    "cache_size": int(os.environ.get("DB_CACHE_SIZE", "-65536")),
+}
+
+# Сколько записей пользователей держать в памяти
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+
+# Размер таблицы лидеров по умолчанию и верхняя граница для ?limit=
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", "3"))
+LEADERBOARD_MAX_SIZE = int(os.environ.get("LEADERBOARD_MAX_SIZE", "100"))
+# Сколько соседей сверху и снизу показывать в /rank по умолчанию и максимум
+RANK_NEIGHBOURS = int(os.environ.get("RANK_NEIGHBOURS", "2"))
+RANK_MAX_NEIGHBOURS = int(os.environ.get("RANK_MAX_NEIGHBOURS", "10"))
+# Распределение результатов: ячейки счётчиков 0..SCORE_DISTRIBUTION_MAX
+# (значения за границами попадают в крайние ячейки)
+SCORE_DISTRIBUTION_MAX = int(os.environ.get("SCORE_DISTRIBUTION_MAX", "10000"))
+DISTRIBUTION_BUCKET_SIZE = int(os.environ.get("DISTRIBUTION_BUCKET_SIZE", "10"))
+DISTRIBUTION_PERCENTILES = os.environ.get("DISTRIBUTION_PERCENTILES", "50,90,99")
+# Окна /leaderboard?window=, для которых ведутся таблицы лучших результатов
+LEADERBOARD_WINDOWS = ("day", "week")
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Рассылка изменений таблицы лидеров (/leaderboard/stream): размер рассылаемого топа,
+# очередь сообщений на подписчика и интервал keepalive в секундах
+LEADERBOARD_STREAM_SIZE = int(os.environ.get("LEADERBOARD_STREAM_SIZE", str(LEADERBOARD_SIZE)))
+LEADERBOARD_STREAM_QUEUE_SIZE = int(os.environ.get("LEADERBOARD_STREAM_QUEUE_SIZE", "16"))
+LEADERBOARD_STREAM_KEEPALIVE = float(os.environ.get("LEADERBOARD_STREAM_KEEPALIVE", "15"))
+
+# Сколько последних результатов хранится в user_aggregates
+LAST_SCORES_COUNT = 5
+
+# Постраничная выдача /user-stats
+USER_STATS_PAGE_SIZE = int(os.environ.get("USER_STATS_PAGE_SIZE", "100"))
+USER_STATS_MAX_PAGE_SIZE = int(os.environ.get("USER_STATS_MAX_PAGE_SIZE", "1000"))
+# Сколько готовых страниц /user-stats хранится для текущей версии данных
+USER_STATS_BODY_CACHE_SIZE = int(os.environ.get("USER_STATS_BODY_CACHE_SIZE", "64"))
+
+# Пакетная загрузка результатов: размер пакета и допустимое время игры от клиента
+SCORE_BATCH_MAX_SIZE = int(os.environ.get("SCORE_BATCH_MAX_SIZE", "1000"))
+SCORE_TIMESTAMP_MAX_AGE = int(os.environ.get("SCORE_TIMESTAMP_MAX_AGE", str(7 * 24 * 3600)))
+SCORE_TIMESTAMP_MAX_SKEW = int(os.environ.get("SCORE_TIMESTAMP_MAX_SKEW", "300"))
+
+# Режим записи результатов: "sync" - сразу в базу, "queue" - через очередь с групповой фиксацией
+SCORE_WRITE_MODE = os.environ.get("SCORE_WRITE_MODE", "sync")
+SCORE_QUEUE_SIZE = int(os.environ.get("SCORE_QUEUE_SIZE", "10000"))
+SCORE_QUEUE_BATCH_SIZE = int(os.environ.get("SCORE_QUEUE_BATCH_SIZE", "500"))
+SCORE_QUEUE_FLUSH_MS = int(os.environ.get("SCORE_QUEUE_FLUSH_MS", "50"))
+SCORE_QUEUE_RETRIES = int(os.environ.get("SCORE_QUEUE_RETRIES", "5"))
+
+# Фоновое удаление результатов удалённых аккаунтов: строк за транзакцию, пауза между
+# порциями и интервал проверки в секундах; incremental_vacuum - раз в VACUUM_INTERVAL
+# секунд, не больше VACUUM_PAGES страниц за раз
+PURGE_CHUNK_SIZE = int(os.environ.get("PURGE_CHUNK_SIZE", "500"))
+PURGE_CHUNK_PAUSE = float(os.environ.get("PURGE_CHUNK_PAUSE", "0.05"))
+PURGE_INTERVAL = float(os.environ.get("PURGE_INTERVAL", "60"))
+VACUUM_INTERVAL = float(os.environ.get("VACUUM_INTERVAL", "300"))
+VACUUM_PAGES = int(os.environ.get("VACUUM_PAGES", "1000"))
+
+# Хранение истории: результаты старше RETENTION_DAYS суток сворачиваются в дневные сводки
+# (score_daily) и уходят в архив RETENTION_ARCHIVE_DIR; 0 - хранить всё. Лучший результат
+# и последние LAST_SCORES_COUNT игр игрока остаются в scores
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "0"))
+RETENTION_CHUNK_SIZE = int(os.environ.get("RETENTION_CHUNK_SIZE", "2000"))
+RETENTION_CHUNK_PAUSE = float(os.environ.get("RETENTION_CHUNK_PAUSE", "0.05"))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))
+RETENTION_ARCHIVE_DIR = os.environ.get(
+    "RETENTION_ARCHIVE_DIR", os.path.splitext(DATABASE_FILE)[0] + "_archive"
+)
+
+# Выгрузка результатов (/admin/export, команда export): доступ у пользователей с флагом
+# users.is_admin (команды grant-admin / revoke-admin); строк в одной порции чтения и кодирования
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "10000"))
+EXPORT_MAGIC = b"FBSCORE1"
+
+# Ограничение частоты запросов на пользователя (token bucket): пополнение в запросах
+# в секунду и размер всплеска; RATE = 0 отключает ограничение для маршрута
+RATE_LIMIT_SCORES_RATE = float(os.environ.get("RATE_LIMIT_SCORES_RATE", "2"))
+RATE_LIMIT_SCORES_BURST = int(os.environ.get("RATE_LIMIT_SCORES_BURST", "10"))
+RATE_LIMIT_SCORES_BATCH_RATE = float(os.environ.get("RATE_LIMIT_SCORES_BATCH_RATE", "0.2"))
+RATE_LIMIT_SCORES_BATCH_BURST = int(os.environ.get("RATE_LIMIT_SCORES_BATCH_BURST", "5"))
+# Сколько корзин держать в памяти; самые давно неактивные вытесняются
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+# Метрики для /metrics: middleware по маршрутам и время именованных SQL-запросов
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
 class UserCreate(BaseModel):
     username: str
@@ -33,6 +190,7 @@ class UserOut(BaseModel):
 
 class ScoreCreate(BaseModel):
     score: int
+    timestamp: Optional[int] = None
 
 class PasswordChange(BaseModel):
     current_password: str
@@ -44,23 +202,108 @@ class UserStats(BaseModel):
     average_score: float
     last_game_date: Optional[datetime]
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+def format_password_hash(iterations: int, salt: bytes, digest: bytes) -> str:
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+def parse_password_hash(hashed_password: str):
+    # (iterations, salt, expected_hex) или None для старого формата
+    if not hashed_password.startswith("pbkdf2_sha256$"):
+        return None
+    _, iterations, salt, expected = hashed_password.split("$")
+    return int(iterations), bytes.fromhex(salt), expected
+
+def verify_legacy_password(plain_password: str, hashed_password: str) -> bool:
+    # Старый формат: sha256 без соли
+    legacy = hashlib.sha256(plain_password.encode()).hexdigest()
+    return hmac.compare_digest(legacy, hashed_password)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    parsed = parse_password_hash(hashed_password)
+    return parsed is None or parsed[0] != PASSWORD_HASH_ITERATIONS
+
+class PasswordHasher:
+    # Хэширование и проверка паролей в отдельных процессах: медленный KDF
+    # не блокирует цикл событий, а вход масштабируется по ядрам
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING,
+                 iterations=PASSWORD_HASH_ITERATIONS):
+        self.iterations = iterations
+        self.max_pending = max_pending
+        self.pending = 0
+        self._workers = workers
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        # Не fork: процессы создаются при первом входе, когда в сервере уже работают
+        # фоновые потоки и открыты соединения SQLite. В процесс передаётся только
+        # hashlib.pbkdf2_hmac, поэтому модуль сервера там не нужен
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=self._workers, mp_context=context)
+
+    async def _pbkdf2(self, password, salt, iterations):
+        executor = self._executor
+        loop = asyncio.get_running_loop()
+        args = ("sha256", password.encode(), salt, iterations)
+        try:
+            return await loop.run_in_executor(executor, hashlib.pbkdf2_hmac, *args)
+        except BrokenProcessPool:
+            # Процесс пула погиб: пересоздаём пул (один раз на все ожидающие запросы)
+            # и повторяем операцию, иначе все входы отвечали бы 500 до перезапуска
+            if self._executor is executor:
+                print("Password hashing pool is broken, restarting it")
+                executor.shutdown(wait=False)
+                self._executor = self._create_executor()
+            return await loop.run_in_executor(self._executor, hashlib.pbkdf2_hmac, *args)
+
+    async def _submit(self, func, *args):
+        # Счётчик меняется только в цикле событий, блокировка не нужна
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many pending password operations, try again later",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await func(*args)
+        finally:
+            self.pending -= 1
+
+    async def _hash(self, password):
+        salt = os.urandom(16)
+        return format_password_hash(self.iterations, salt, await self._pbkdf2(password, salt, self.iterations))
+
+    async def _verify(self, password, hashed):
+        parsed = parse_password_hash(hashed)
+        if parsed is None:
+            return verify_legacy_password(password, hashed)
+        iterations, salt, expected = parsed
+        digest = await self._pbkdf2(password, salt, iterations)
+        return hmac.compare_digest(digest.hex(), expected)
+
+    async def hash(self, password):
+        return await self._submit(self._hash, password)
+
+    async def verify(self, password, hashed):
+        return await self._submit(self._verify, password, hashed)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return hash_password(plain_password) == hashed_password
+    def close(self):
+        self._executor.shutdown(wait=True)
 
-def create_token(user_id: int) -> str:
+def create_token(user_id: int, generation: int = 0) -> str:
+    # gen - поколение токенов пользователя; смена пароля или удаление аккаунта
+    # увеличивают его и тем самым отзывают все выданные ранее токены
     payload = {
         "sub": str(user_id),
-        "exp": datetime.utcnow() + timedelta(hours=24),
+        "gen": generation,
+        "exp": datetime.utcnow() + TOKEN_LIFETIME,
     }
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
-def verify_token(token: str) -> int:
+def decode_token(token: str) -> tuple:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return int(payload["sub"])
+        return int(payload["sub"]), int(payload.get("gen", 0)), payload["exp"]
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
@@ -70,82 +313,1904 @@ def verify_token(token: str) -> int:
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
         )
 
-def create_tables():
+class Metric:
+    # Серии метрики: кортеж значений меток -> значение. Обновления идут из цикла
+    # событий и из потоков базы, поэтому под блокировкой; текст собирается только в /metrics
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _series(self, name, labels, value, extra=()):
+        pairs = [f'{key}="{escape_label(val)}"' for key, val in zip(self.labels, labels)]
+        pairs += [f'{key}="{val}"' for key, val in extra]
+        label_text = "{" + ",".join(pairs) + "}" if pairs else ""
+        return f"{name}{label_text} {value}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(self._series(self.name, labels, value))
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        # callback - значение считается в момент чтения /metrics
+        self.callback = callback
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def render(self):
+        if self.callback is not None:
+            with self._lock:
+                self._values[()] = self.callback()
+        return super().render()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        # Счётчики по корзинам не накопительные, суммы считаются при выводе
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(self._series(f"{self.name}_bucket", labels, cumulative, [("le", bound)]))
+            lines.append(self._series(f"{self.name}_sum", labels, round(total, 6)))
+            lines.append(self._series(f"{self.name}_count", labels, cumulative))
+        return lines
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route", ("method", "route")
+)
+HTTP_REQUESTS_TOTAL = Counter(
+    "http_requests_total", "Requests by route and status code", ("method", "route", "status")
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests being processed by route", ("method", "route")
+)
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "SQL time by named query", ("query",))
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Failed SQL by named query", ("query",))
+RATE_LIMITED_TOTAL = Counter("rate_limited_total", "Requests rejected with 429 by route", ("route",))
+
+@contextmanager
+def timed_query(name):
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        c = conn.cursor()
-        
-        # Создание таблицы пользователей
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        ''')
-        
-        # Создание таблицы счета
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS scores (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                score INTEGER NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        
-        # Добавляем индексы для оптимизации запросов
-        c.execute('CREATE INDEX IF NOT EXISTS idx_scores_user_id ON scores(user_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_scores_score ON scores(score)')
-        
-        conn.commit()
-    except Exception as e:
-        print(f"Error creating tables: {e}")
+        yield
+    except Exception:
+        DB_QUERY_ERRORS.inc((name,))
+        raise
     finally:
-        conn.close()
+        DB_QUERY_SECONDS.observe((name,), time.perf_counter() - started)
 
-def load_database():
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users")
-    rows = c.fetchall()
-    users = []
-    for row in rows:
+# Шаблон маршрута ("/scores/batch") для пути запроса; пути без параметров запоминаются
+_route_templates = {}
+
+def route_template(scope):
+    path = scope["path"]
+    template = _route_templates.get(path)
+    if template is None:
+        template = "unmatched"
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match != Match.NONE:
+                template = getattr(route, "path", template)
+                break
+        if "{" not in template and len(_route_templates) < 1000:
+            _route_templates[path] = template
+    return template
+
+class MetricsMiddleware:
+    # Чистый ASGI middleware: без BaseHTTPMiddleware и лишних копий тела ответа
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        labels = (scope["method"], route_template(scope))
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc(labels)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec(labels)
+            HTTP_REQUEST_SECONDS.observe(labels, time.perf_counter() - started)
+            HTTP_REQUESTS_TOTAL.inc(labels + (status_code,))
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# Срок, до которого должен завершиться текущий запрос потока (см. run_db)
+_query_deadline = threading.local()
+
+def _query_deadline_exceeded():
+    deadline = getattr(_query_deadline, "value", None)
+    # Ненулевой ответ прерывает выполнение запроса в SQLite
+    return 1 if deadline is not None and time.monotonic() > deadline else 0
+
+class ConnectionPool:
+    def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 pragmas=None, health_check_interval=DB_HEALTH_CHECK_INTERVAL):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = DB_PRAGMAS if pragmas is None else pragmas
+        self.health_check_interval = health_check_interval
+        # LIFO: чаще используемые соединения держат "тёплый" кэш страниц
+        self._idle = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self._idle.put((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        conn.set_progress_handler(_query_deadline_exceeded, 10000)
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _replace(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        return self._connect()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn, last_used = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Database connection pool exhausted")
+
+        try:
+            # Проверяем соединения, которые долго простаивали
+            if time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(conn):
+                conn = self._replace(conn)
+        except Exception:
+            self._idle.put((self._connect(), time.monotonic()))
+            raise
+
+        try:
+            yield conn
+        finally:
+            # Незавершённая транзакция не должна попасть к следующему запросу
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                conn = self._replace(conn)
+            self._idle.put((conn, time.monotonic()))
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class UserRepository:
+    # Поиск идёт по PRIMARY KEY и UNIQUE-индексу на username (B-дерево, O(log n))
+    COLUMNS = "id, username, password, created_at, token_generation"
+
+    def __init__(self, pool, cache_size=USER_CACHE_SIZE):
+        self.pool = pool
+        self._by_id = LRUCache(cache_size)
+        self._id_by_username = LRUCache(cache_size)
+
+    @staticmethod
+    def _row_to_user(row):
         created_at = row[3]
         if isinstance(created_at, str):
             created_at = datetime.fromisoformat(created_at)
-        users.append({
+        return {
             "id": row[0],
             "username": row[1],
             "password": row[2],
             "created_at": created_at,
-        })
-    conn.close()
-    return users
+            "token_generation": row[4],
+        }
+
+    def _remember(self, user):
+        self._by_id.put(user["id"], user)
+        self._id_by_username.put(user["username"], user["id"])
+        return user
+
+    def _fetch_one(self, where, value):
+        with self.pool.connection() as conn, timed_query(f"user_by_{where}"):
+            row = conn.execute(
+                f"SELECT {self.COLUMNS} FROM users WHERE {where} = ?", (value,)
+            ).fetchone()
+        if row is None:
+            return None
+        return self._remember(self._row_to_user(row))
+
+    def cached_by_id(self, user_id):
+        return self._by_id.get(user_id)
+
+    def cached_by_username(self, username):
+        user_id = self._id_by_username.get(username)
+        return None if user_id is None else self._by_id.get(user_id)
+
+    def get_by_id(self, user_id):
+        user = self._by_id.get(user_id)
+        if user is None:
+            user = self._fetch_one("id", user_id)
+        return user
+
+    def get_by_username(self, username):
+        user_id = self._id_by_username.get(username)
+        if user_id is not None:
+            user = self._by_id.get(user_id)
+            if user is not None:
+                return user
+        return self._fetch_one("username", username)
+
+    def exists(self, username):
+        return self.get_by_username(username) is not None
+
+    def create(self, username, password_hash):
+        new_user = {
+            "id": None,
+            "username": username,
+            "password": password_hash,
+            "created_at": datetime.utcnow().isoformat(),
+            "token_generation": 0,
+        }
+        with self.pool.connection() as conn, timed_query("user_insert"):
+            new_user["id"] = save_user(conn, new_user)
+        new_user["created_at"] = datetime.fromisoformat(new_user["created_at"])
+        return self._remember(new_user)
+
+    def replace_password(self, user_id, old_hash, new_hash):
+        # Меняет хэш, только если пароль не успели сменить параллельно. Событие с текущим
+        # поколением сбрасывает игрока в кэшах других процессов, не отзывая токены
+        with self.pool.connection() as conn, timed_query("password_rehash"):
+            rows = conn.execute(
+                "UPDATE users SET password = ? WHERE id = ? AND password = ? RETURNING token_generation",
+                (new_hash, user_id, old_hash),
+            ).fetchall()
+            if rows:
+                record_cache_event(conn, "password", user_id, rows[0][0])
+            conn.commit()
+        self.invalidate(user_id)
+        return bool(rows)
+
+    def invalidate(self, user_id):
+        user = self._by_id.pop(user_id)
+        if user is not None:
+            self._id_by_username.pop(user["username"])
+
+    def clear(self):
+        self._by_id.clear()
+        self._id_by_username.clear()
+
+class TokenCache:
+    # Проверенные токены (ключ - sha256 токена) и отзывы, сделанные этим процессом.
+    # Попадание в кэш не требует ни проверки подписи, ни обращения к базе
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self._verified = LRUCache(maxsize)
+        # user_id -> (минимальное действующее поколение, время отзыва)
+        self._revoked = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        digest = self._digest(token)
+        entry = self._verified.get(digest)
+        if entry is None:
+            return None
+        user_id, generation, exp = entry
+        if exp <= time.time():
+            self._verified.pop(digest)
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
+            )
+        if self.is_revoked(user_id, generation):
+            self._verified.pop(digest)
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked"
+            )
+        return user_id
+
+    def put(self, token, user_id, generation, exp):
+        self._verified.put(self._digest(token), (user_id, generation, exp))
+
+    def is_revoked(self, user_id, generation):
+        revoked = self._revoked.get(user_id)
+        return revoked is not None and generation < revoked[0]
+
+    def revoke(self, user_id, generation=None):
+        # generation=None - отзываются все токены (аккаунт удалён)
+        now = time.time()
+        with self._lock:
+            # Записи старше срока жизни токена больше ничего не отзывают
+            lifetime = TOKEN_LIFETIME.total_seconds()
+            for stale in [uid for uid, (_, at) in self._revoked.items() if now - at > lifetime]:
+                del self._revoked[stale]
+            self._revoked[user_id] = (float("inf") if generation is None else generation, now)
+
+    def clear(self):
+        self._verified.clear()
+
+class RateLimiter:
+    # Token bucket на пару (маршрут, пользователь). Корзины лежат в OrderedDict
+    # в порядке последнего обращения: проверка - O(1), при переполнении вытесняется
+    # самая давно неактивная корзина (её всё равно уже успело бы заполнить доверху).
+    # Вызывается только из цикла событий, блокировка не нужна
+    def __init__(self, limits, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        # limits: маршрут -> (пополнение в секунду, размер всплеска)
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+
+    def check(self, route, key, cost=1):
+        # Возвращает 0, если запрос разрешён, иначе сколько секунд подождать
+        rate, burst = self.limits[route]
+        if rate <= 0:
+            return 0
+        now = time.monotonic()
+        bucket_key = (route, key)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            tokens = burst
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            self._buckets.move_to_end(bucket_key)
+
+        if tokens < cost:
+            self._buckets[bucket_key] = (tokens, now)
+            return (cost - tokens) / rate
+        self._buckets[bucket_key] = (tokens - cost, now)
+        return 0
+
+    def limit(self, route, key, cost=1):
+        retry_after = self.check(route, key, cost)
+        if retry_after:
+            RATE_LIMITED_TOTAL.inc((route,))
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, slow down",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+    def __len__(self):
+        return len(self._buckets)
+
+class DataVersion:
+    # Версия данных для ETag: растёт при каждом изменении результатов или аккаунтов.
+    # Эпоха (момент запуска процесса) не даёт совпасть версиям до и после перезапуска
+    def __init__(self):
+        self._epoch = format(time.time_ns(), "x")
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+
+    def etag(self, suffix=""):
+        # suffix различает представления, которые меняются и без записи (окна по времени)
+        return f'"{self._epoch}-{self._value}{"-" + suffix if suffix else ""}"'
+
+def encode_json(content):
+    # orjson, если установлен; иначе те же байты, что у стандартного JSONResponse
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return encode_json(content)
+
+def json_body_response(body, headers=None):
+    # Уже закодированное тело: без jsonable_encoder и повторной сериализации
+    return Response(body, media_type="application/json", headers=headers)
+
+class BodyCache:
+    # Закодированные ответы для одной версии данных (ETag): при смене версии
+    # кэш сбрасывается целиком, поэтому устаревшее тело отдать нельзя
+    def __init__(self, size):
+        self._size = size
+        self._version = None
+        self._bodies = {}
+
+    def get(self, version, key):
+        if version != self._version:
+            return None
+        return self._bodies.get(key)
+
+    def put(self, version, key, body):
+        if version != self._version:
+            self._version = version
+            self._bodies = {}
+        if len(self._bodies) < self._size:
+            self._bodies[key] = body
+
+class _BisectList:
+    # Запасной вариант, если sortedcontainers не установлен
+    def __init__(self):
+        self._items = []
+
+    def add(self, value):
+        insort(self._items, value)
+
+    def remove(self, value):
+        i = bisect_left(self._items, value)
+        if i == len(self._items) or self._items[i] != value:
+            raise ValueError(f"{value!r} not in list")
+        del self._items[i]
+
+    def bisect_left(self, value):
+        return bisect_left(self._items, value)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+class ScoreCounts:
+    # Число результатов с каждым значением: обновление O(1), перцентили и гистограмма
+    # считаются одним проходом по массиву. Сумма и количество точные и для значений
+    # за границами массива
+    def __init__(self, max_score=SCORE_DISTRIBUTION_MAX):
+        self._counts = [0] * (max_score + 1)
+        self._total = 0
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def add(self, score, count=1):
+        with self._lock:
+            self._counts[min(max(score, 0), len(self._counts) - 1)] += count
+            self._total += count
+            self._sum += score * count
+
+    def remove(self, score, count=1):
+        self.add(score, -count)
+
+    def summary(self, percentiles, bucket_size):
+        # Копия под блокировкой, проход по ней - без блокировки
+        with self._lock:
+            counts = list(self._counts)
+            total, total_sum = self._total, self._sum
+
+        # Перцентиль p - наименьший результат, не меньше которого p% значений (nearest rank)
+        values = {}
+        targets = iter(sorted((max(1, math.ceil(p * total / 100)), p) for p in percentiles))
+        target = next(targets, None) if total else None
+        seen = 0
+        for score, count in enumerate(counts):
+            seen += count
+            while target is not None and seen >= target[0]:
+                values[target[1]] = score
+                target = next(targets, None)
+            if target is None:
+                break
+
+        histogram = []
+        for start in range(0, len(counts), bucket_size):
+            count = sum(counts[start:start + bucket_size])
+            if count:
+                histogram.append({
+                    "from": start,
+                    "to": min(start + bucket_size, len(counts)) - 1,
+                    "count": count
+                })
+
+        return {
+            "count": total,
+            "average": round(total_sum / total, 2) if total else 0,
+            "percentiles": {f"p{p:g}": values.get(p) for p in percentiles},
+            "histogram": histogram,
+        }
+
+class LeaderboardIndex:
+    # Лучший результат каждого игрока, упорядоченный по убыванию.
+    # Ключ (-score, user_id): при равенстве выше тот, кто зарегистрировался раньше.
+    # bests - распределение лучших результатов, меняется вместе с рейтингом
+    def __init__(self):
+        self._ranking = SortedList() if SortedList is not None else _BisectList()
+        self._best = {}
+        self._lock = threading.Lock()
+        self.bests = ScoreCounts()
+        # limit -> закодированный топ; сбрасывается при любом изменении рейтинга
+        self._bodies = {}
+
+    def build(self, rows):
+        # rows: (user_id, username, best_score), см. load_leaderboard_rows
+        with self._lock:
+            self._ranking = SortedList() if SortedList is not None else _BisectList()
+            self._best = {}
+            self.bests = ScoreCounts()
+            self._bodies = {}
+            for user_id, username, score in rows:
+                self._best[user_id] = (score, username)
+                self._ranking.add((-score, user_id))
+                self.bests.add(score)
+
+    def record(self, user_id, username, score):
+        with self._lock:
+            current = self._best.get(user_id)
+            if current is not None:
+                if score <= current[0]:
+                    return False
+                self._ranking.remove((-current[0], user_id))
+                self.bests.remove(current[0])
+            self._best[user_id] = (score, username)
+            self._ranking.add((-score, user_id))
+            self.bests.add(score)
+            self._bodies = {}
+            return True
+
+    def remove(self, user_id):
+        with self._lock:
+            current = self._best.pop(user_id, None)
+            if current is None:
+                return False
+            self._ranking.remove((-current[0], user_id))
+            self.bests.remove(current[0])
+            self._bodies = {}
+            return True
+
+    def _top(self, limit):
+        results = []
+        for position, (_, user_id) in enumerate(islice(self._ranking, limit), 1):
+            score, username = self._best[user_id]
+            results.append({
+                "position": position,
+                "username": username,
+                "score": score
+            })
+        return results
+
+    def top(self, limit):
+        with self._lock:
+            return self._top(limit)
+
+    def top_json(self, limit):
+        # Топ кодируется один раз на каждое изменение рейтинга, а не на каждый запрос
+        with self._lock:
+            body = self._bodies.get(limit)
+            if body is None:
+                body = self._bodies[limit] = encode_json(self._top(limit))
+            return body
+
+    def rank(self, user_id, neighbours=0):
+        # Место игрока за O(log n): позиция его ключа в упорядоченном списке,
+        # соседи - срез по индексам
+        with self._lock:
+            current = self._best.get(user_id)
+            if current is None:
+                return None
+            score, username = current
+            total = len(self._ranking)
+            index = self._ranking.bisect_left((-score, user_id))
+            # (-score,) меньше любого ключа с этим результатом: сколько игроков выше по очкам
+            higher = self._ranking.bisect_left((-score,))
+            lower = total - self._ranking.bisect_left((-score + 1,))
+
+            def entries(start, stop):
+                return [
+                    {"position": position, "username": self._best[uid][1], "score": -key}
+                    for position, (key, uid) in enumerate(self._ranking[start:stop], start + 1)
+                ]
+
+            return {
+                "username": username,
+                "score": score,
+                "position": index + 1,
+                # Игроки с одинаковым результатом делят место
+                "rank": higher + 1,
+                "players": total,
+                # Доля игроков с меньшим лучшим результатом
+                "percentile": round(100 * lower / total, 1),
+                "above": entries(max(0, index - neighbours), index),
+                "below": entries(index + 1, min(total, index + 1 + neighbours)),
+            }
+
+    def __len__(self):
+        return len(self._best)
+
+class LeaderboardStream:
+    # Подписчики /leaderboard/stream. Изменение топа считается и кодируется один раз,
+    # каждому подписчику достаётся только ссылка на готовое сообщение в его очереди.
+    # Всё состояние меняется в цикле событий; notify можно вызывать из любого потока
+    def __init__(self, size=LEADERBOARD_STREAM_SIZE, queue_size=LEADERBOARD_STREAM_QUEUE_SIZE):
+        self.size = size
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._top = []
+        self._version = 0
+        self._pending = False
+        self._loop = None
+
+    def _event(self, name, payload):
+        return f"id: {self._version}\nevent: {name}\ndata: {json.dumps(payload)}\n\n"
+
+    def _snapshot(self):
+        return self._event("snapshot", {"leaderboard": self._top})
+
+    def subscribe(self):
+        self._loop = asyncio.get_running_loop()
+        if not self._subscribers:
+            # Без подписчиков изменения не отслеживаются - берём текущий топ
+            self._top = leaderboard.top(self.size)
+        subscriber = asyncio.Queue(self.queue_size)
+        subscriber.put_nowait(self._snapshot())
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def notify(self):
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        try:
+            loop.call_soon_threadsafe(self._schedule)
+        except RuntimeError:
+            # Цикл событий уже закрыт (остановка сервера)
+            pass
+
+    def _schedule(self):
+        # Несколько изменений за одну итерацию цикла дают одну рассылку
+        if not self._pending:
+            self._pending = True
+            self._loop.call_soon(self._publish)
+
+    def _publish(self):
+        self._pending = False
+        top = leaderboard.top(self.size)
+        changes = [item for index, item in enumerate(top)
+                   if index >= len(self._top) or self._top[index] != item]
+        if not changes and len(top) == len(self._top):
+            return
+        self._top = top
+        self._version += 1
+        message = self._event("diff", {"size": len(top), "changes": changes})
+        for subscriber in self._subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except asyncio.QueueFull:
+                # Подписчик не успевает читать - вместо накопленных diff отдаём снимок
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(self._snapshot())
+
+    def close(self):
+        # None завершает потоки подписчиков
+        for subscriber in self._subscribers:
+            while not subscriber.empty():
+                subscriber.get_nowait()
+            subscriber.put_nowait(None)
+        self._subscribers.clear()
+        self._loop = None
+
+    def __len__(self):
+        return len(self._subscribers)
+
+class ScoreWriter:
+    # Единственный фоновый писатель: забирает результаты из ограниченной очереди
+    # и фиксирует их пачками по batch_size строк или раз в flush_ms миллисекунд
+    def __init__(self, maxsize=SCORE_QUEUE_SIZE, batch_size=SCORE_QUEUE_BATCH_SIZE,
+                 flush_ms=SCORE_QUEUE_FLUSH_MS, retries=SCORE_QUEUE_RETRIES):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.retries = retries
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.batches_committed = 0
+        self.rows_committed = 0
+        self.rows_failed = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self._thread = threading.Thread(target=self._run, name="score-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, score, created_at):
+        # False - очередь переполнена или писатель останавливается
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put_nowait((user_id, score, created_at))
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    # После остановки дочищаем очередь без ожидания
+                    if self._stopping.is_set():
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit_shard(self, shard, by_user):
+        # Одна транзакция на базу; в шардированном режиме пачка делится по шардам.
+        # Возвращает записанных игроков (без удалённых за время ожидания) или None при ошибке
+        rows = sum(len(items) for items in by_user.values())
+        for attempt in range(self.retries + 1):
+            try:
+                with shard.connection() as conn, timed_query("score_insert_batch"):
+                    c = conn.cursor()
+                    written = {
+                        user_id: items for user_id, items in by_user.items()
+                        if insert_scores(c, user_id, items)
+                    }
+                    conn.commit()
+                return written
+            except sqlite3.Error as e:
+                if attempt == self.retries:
+                    print(f"Error committing {rows} queued scores: {e}")
+                    return None
+                time.sleep(min(0.05 * 2 ** attempt, 1))
+
+    def _commit(self, batch):
+        by_shard = {}
+        for user_id, score, created_at in batch:
+            by_shard.setdefault(score_pool(user_id), {}).setdefault(user_id, []).append((score, created_at))
+
+        committed = {}
+        failed = 0
+        for shard, by_user in by_shard.items():
+            written = self._commit_shard(shard, by_user)
+            if written is None:
+                failed += sum(len(items) for items in by_user.values())
+            else:
+                committed.update(written)
+        rows = sum(len(items) for items in committed.values())
+
+        with self._stats_lock:
+            self.rows_failed += failed
+            if not committed:
+                return
+            self.batches_committed += 1
+            self.rows_committed += rows
+            self.last_batch_size = rows
+            self.max_batch_size = max(self.max_batch_size, rows)
+
+        changed = False
+        for user_id, items in committed.items():
+            for score, _ in items:
+                score_counts.add(score)
+            user = user_repository.get_by_id(user_id)
+            if user is not None:
+                changed |= leaderboard.record(user_id, user["username"], max(score for score, _ in items))
+        data_version.bump()
+        if changed:
+            leaderboard_stream.notify()
+
+    def close(self):
+        # Дожидаемся, пока всё принятое в очередь будет записано
+        self._stopping.set()
+        self._thread.join()
+
+    def metrics(self):
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "batches_committed": self.batches_committed,
+                "rows_committed": self.rows_committed,
+                "rows_failed": self.rows_failed,
+                "last_batch_size": self.last_batch_size,
+                "max_batch_size": self.max_batch_size,
+                "avg_batch_size": round(self.rows_committed / self.batches_committed, 1)
+                if self.batches_committed else 0,
+            }
+
+class AccountPurger:
+    # Удаляет результаты удалённых аккаунтов (account_purges) порциями по chunk_size строк,
+    # каждая - отдельная короткая транзакция: между ними блокировка записи свободна.
+    # Здесь же по расписанию возвращает освободившиеся страницы (incremental_vacuum)
+    def __init__(self, chunk_size=PURGE_CHUNK_SIZE, pause=PURGE_CHUNK_PAUSE, interval=PURGE_INTERVAL,
+                 vacuum_interval=VACUUM_INTERVAL, vacuum_pages=VACUUM_PAGES):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.interval = interval
+        self.vacuum_interval = vacuum_interval
+        self.vacuum_pages = vacuum_pages
+        self.rows_purged = 0
+        self.accounts_purged = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="account-purger", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        next_vacuum = time.monotonic() + self.vacuum_interval
+        while not self._stopping.is_set():
+            busy = False
+            try:
+                busy = self.purge_once()
+                if time.monotonic() >= next_vacuum:
+                    self.vacuum()
+                    next_vacuum = time.monotonic() + self.vacuum_interval
+            except sqlite3.Error as e:
+                print(f"Error purging deleted accounts: {e}")
+            if busy:
+                self._stopping.wait(self.pause)
+            else:
+                self._wake.wait(max(0, min(self.interval, next_vacuum - time.monotonic())))
+                self._wake.clear()
+
+    def _purge_chunk(self, scores_pool):
+        with scores_pool.connection() as conn, timed_query("account_purge"):
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute('''
+                SELECT user_id FROM account_purges
+                WHERE purged_at IS NULL
+                ORDER BY deleted_at
+                LIMIT 1
+            ''').fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            user_id = row[0]
+            scores = [score for (score,) in conn.execute('''
+                DELETE FROM scores
+                WHERE id IN (SELECT id FROM scores WHERE user_id = ? LIMIT ?)
+                RETURNING score
+            ''', (user_id, self.chunk_size))]
+            # Последняя порция: убираем остальное, отметка остаётся как надгробие
+            done = len(scores) < self.chunk_size
+            compacted = []
+            if done:
+                compacted = conn.execute(
+                    "DELETE FROM compacted_scores WHERE user_id = ? RETURNING score, games", (user_id,)
+                ).fetchall()
+                conn.execute("DELETE FROM score_daily WHERE user_id = ?", (user_id,))
+                conn.execute("DELETE FROM window_best WHERE user_id = ?", (user_id,))
+                conn.execute("DELETE FROM user_aggregates WHERE user_id = ?", (user_id,))
+                conn.execute(
+                    "UPDATE account_purges SET purged_at = ? WHERE user_id = ?",
+                    (datetime.now(timezone.utc).isoformat(), user_id),
+                )
+            if scores or compacted:
+                record_cache_event(
+                    conn, "purged", user_id, [[score, 1] for score in scores] + [list(row) for row in compacted]
+                )
+            conn.commit()
+
+        for score in scores:
+            score_counts.remove(score)
+        for score, games in compacted:
+            score_counts.remove(score, games)
+        if scores or compacted or done:
+            data_version.bump()
+        self.rows_purged += len(scores)
+        self.accounts_purged += done
+        return scores
+
+    def purge_once(self):
+        # По порции из каждой базы; True - работа ещё могла остаться
+        return any([self._purge_chunk(scores_pool) is not None for scores_pool in score_pools()])
+
+    def vacuum(self):
+        for database in [pool] + shard_pools:
+            with database.connection() as conn, timed_query("incremental_vacuum"):
+                conn.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+
+    def close(self):
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join()
+
+class ScoreCompactor:
+    # Сворачивает результаты старше days суток в score_daily (игры, сумма, максимум за сутки)
+    # и compacted_scores (число игр с каждым значением - для распределения).
+    # Порция - chunk_size строк в порядке id: отбор идёт в транзакции чтения, затем строки
+    # пишутся в архив (gzip CSV) и только на удаление и свёртку берётся блокировка записи.
+    # При сбое строки могут попасть в архив повторно, но не пропадут.
+    # compaction_progress.last_id - граница, до которой все строки уже рассмотрены:
+    # фоновый проход начинает с неё, команда compact (full) - с начала таблицы
+    def __init__(self, days=RETENTION_DAYS, chunk_size=RETENTION_CHUNK_SIZE, pause=RETENTION_CHUNK_PAUSE,
+                 interval=RETENTION_INTERVAL, archive_dir=RETENTION_ARCHIVE_DIR):
+        self.days = days
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.interval = interval
+        self.archive_dir = archive_dir
+        self.rows_compacted = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="score-compactor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.compact()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Error compacting scores: {e}")
+            self._stopping.wait(self.interval)
+
+    def compact(self, full=False):
+        # Один проход по всем базам в порядке id; сворачиваются только целые сутки
+        cutoff_day = (datetime.now(timezone.utc) - UNIX_EPOCH).days - self.days
+        # id растёт со временем записи, а время игры из /scores/batch отстаёт от него не больше
+        # чем на SCORE_TIMESTAMP_MAX_AGE: после строки новее этого запаса старых строк нет
+        stop_day = cutoff_day + SCORE_TIMESTAMP_MAX_AGE // 86400 + 1
+        compacted = 0
+        for scores_pool in score_pools():
+            with scores_pool.connection() as conn:
+                progress = conn.execute("SELECT last_id FROM compaction_progress").fetchone()[0]
+            after = settled = 0 if full else progress
+            # Граница двигается, пока не встретилась строка моложе cutoff_day: её и всё
+            # после неё следующий проход рассмотрит снова
+            frozen = False
+            while not self._stopping.is_set():
+                rows, after, last_old, fresh, done = self._compact_chunk(scores_pool, after, cutoff_day, stop_day)
+                compacted += rows
+                if not frozen:
+                    settled = max(settled, last_old)
+                    frozen = fresh
+                if done:
+                    break
+                self._stopping.wait(self.pause)
+            if settled > progress:
+                with scores_pool.connection() as conn:
+                    conn.execute("UPDATE compaction_progress SET last_id = ?", (settled,))
+                    conn.commit()
+        return compacted
+
+    def _compact_chunk(self, scores_pool, after, cutoff_day, stop_day):
+        # Возвращает (свёрнуто строк, последний просмотренный id, id последней старой строки
+        # до первой свежей, встретилась ли свежая строка, проход окончен)
+        with scores_pool.connection() as conn, timed_query("score_compact_scan"):
+            conn.execute("BEGIN")
+            rows = conn.execute('''
+                SELECT s.id, s.user_id, s.score, s.created_at, a.best_score, p.user_id IS NOT NULL
+                FROM scores s
+                LEFT JOIN user_aggregates a ON a.user_id = s.user_id
+                LEFT JOIN account_purges p ON p.user_id = s.user_id
+                WHERE s.id > ?
+                ORDER BY s.id
+                LIMIT ?
+            ''', (after, self.chunk_size)).fetchall()
+            done = len(rows) < self.chunk_size
+            scanned = list(takewhile(lambda row: day_bucket(row[3]) < stop_day, rows))
+            if len(scanned) < len(rows):
+                done = True
+            old_prefix = list(takewhile(lambda row: day_bucket(row[3]) < cutoff_day, scanned))
+            fresh = len(old_prefix) < len(rows)
+            old = [row for row in scanned if day_bucket(row[3]) < cutoff_day]
+            keep = self._kept_ids(conn, old)
+            conn.rollback()
+        compact = [row[:4] for row in old if row[0] not in keep]
+
+        folded = 0
+        if compact:
+            self._archive(scores_pool, compact)
+            with scores_pool.connection() as conn, timed_query("score_compact"):
+                conn.execute("BEGIN IMMEDIATE")
+                # Между отбором и блокировкой строки могли удалить (AccountPurger, другой
+                # процесс сервера): сворачиваются только действительно удалённые здесь
+                deleted = set()
+                for i in range(0, len(compact), 500):
+                    ids = [row[0] for row in compact[i:i + 500]]
+                    deleted.update(row_id for (row_id,) in conn.execute(f'''
+                        DELETE FROM scores
+                        WHERE id IN ({",".join("?" * len(ids))})
+                          AND user_id NOT IN (SELECT user_id FROM account_purges)
+                        RETURNING id
+                    ''', ids))
+                rows_folded = [row for row in compact if row[0] in deleted]
+                self._fold(conn, rows_folded)
+                conn.commit()
+            folded = len(rows_folded)
+
+        self.rows_compacted += folded
+        last_old = old_prefix[-1][0] if old_prefix else after
+        return folded, scanned[-1][0] if scanned else after, last_old, fresh, done
+
+    def _kept_ids(self, conn, rows):
+        # Из порции остаются последние LAST_SCORES_COUNT игр игрока и строки с его лучшим
+        # результатом; результаты удалённых аккаунтов не трогаем - их вычищает AccountPurger
+        by_user = {}
+        for row in rows:
+            by_user.setdefault(row[1], []).append(row)
+        keep = set()
+        for user_id, user_rows in by_user.items():
+            best, purged = user_rows[0][4], user_rows[0][5]
+            if best is None or purged:
+                keep.update(row[0] for row in user_rows)
+                continue
+            keep.update(row[0] for row in user_rows if row[2] == best)
+            keep.update(row_id for (row_id,) in conn.execute('''
+                SELECT id FROM scores
+                WHERE user_id = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (user_id, LAST_SCORES_COUNT)))
+        return keep
+
+    def _archive(self, scores_pool, rows):
+        # Временный файл и переименование: в архиве не бывает недописанных файлов
+        os.makedirs(self.archive_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(scores_pool.database))[0]
+        path = os.path.join(self.archive_dir, f"{base}-{rows[0][0]}-{rows[-1][0]}.csv.gz")
+        with open(path + ".tmp", "wb") as raw:
+            with gzip.open(raw, "wt", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["id", "user_id", "score", "created_at"])
+                writer.writerows(rows)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _fold(self, conn, rows):
+        daily = {}
+        counts = {}
+        for _, user_id, score, created_at in rows:
+            key = (user_id, day_bucket(created_at))
+            games, score_sum, best = daily.get(key, (0, 0, score))
+            daily[key] = (games + 1, score_sum + score, max(best, score))
+            counts[(user_id, score)] = counts.get((user_id, score), 0) + 1
+        # Строки уже удалены в _compact_chunk (DELETE ... RETURNING), здесь только свёртка
+        conn.executemany('''
+            INSERT INTO score_daily (user_id, day, games, score_sum, best_score)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                games = games + excluded.games,
+                score_sum = score_sum + excluded.score_sum,
+                best_score = MAX(best_score, excluded.best_score)
+        ''', [(user_id, day, *summary) for (user_id, day), summary in daily.items()])
+        conn.executemany('''
+            INSERT INTO compacted_scores (user_id, score, games)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, score) DO UPDATE SET games = games + excluded.games
+        ''', [(user_id, score, games) for (user_id, score), games in counts.items()])
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+class CacheSync:
+    # Согласование кэшей между процессами сервера (SERVER_WORKERS > 1). Запись, которая
+    # видна через кэши (результаты, смена пароля, удаление), добавляет событие в cache_events
+    # той же транзакцией. Поток сверяет PRAGMA data_version своего соединения с каждым
+    # файлом - значение меняется только после коммитов других соединений - и лишь тогда
+    # читает новые события и применяет чужие
+    def __init__(self, cursors, interval=CACHE_SYNC_INTERVAL, ttl=CACHE_EVENT_TTL):
+        self.interval = interval
+        self.ttl = ttl
+        self.events_applied = 0
+        self.resyncs = 0
+        self._worker = os.getpid()
+        # [файл, соединение, последняя data_version, id последнего события]
+        self._watched = [
+            [database, sqlite3.connect(database, check_same_thread=False), None, cursors[database]]
+            for database in cursors
+        ]
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cache-sync", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        next_prune = time.monotonic() + self.ttl / 10
+        while not self._stopping.wait(self.interval):
+            try:
+                self.poll()
+                if time.monotonic() >= next_prune:
+                    self.prune()
+                    next_prune = time.monotonic() + self.ttl / 10
+            except sqlite3.Error as e:
+                print(f"Error syncing caches: {e}")
+
+    def poll(self):
+        for watched in self._watched:
+            _, conn, version, cursor = watched
+            current = conn.execute("PRAGMA data_version").fetchone()[0]
+            if current == version:
+                continue
+            watched[2] = current
+            events = conn.execute('''
+                SELECT id, worker, kind, user_id, payload FROM cache_events
+                WHERE id > ?
+                ORDER BY id
+            ''', (cursor,)).fetchall()
+            # id идут подряд (AUTOINCREMENT); разрыв - события удалены по сроку, пока
+            # процесс отставал: кэши пересобираются целиком
+            if events and events[0][0] != cursor + 1:
+                self.resync()
+                return
+            for event_id, worker, kind, user_id, payload in events:
+                if worker != self._worker:
+                    self._apply(kind, user_id, json.loads(payload))
+                    self.events_applied += 1
+                watched[3] = event_id
+
+    def _apply(self, kind, user_id, payload):
+        changed = False
+        if kind == "scores":
+            for score in payload:
+                score_counts.add(score)
+            user = user_repository.get_by_id(user_id)
+            changed = user is not None and leaderboard.record(user_id, user["username"], max(payload))
+        elif kind == "purged":
+            for score, count in payload:
+                score_counts.remove(score, count)
+        elif kind == "password":
+            user_repository.invalidate(user_id)
+            token_cache.revoke(user_id, payload)
+        elif kind == "delete":
+            user_repository.invalidate(user_id)
+            token_cache.revoke(user_id)
+            changed = leaderboard.remove(user_id)
+        data_version.bump()
+        if changed:
+            leaderboard_stream.notify()
+
+    def resync(self):
+        global score_counts
+        leaderboard.build(load_leaderboard_rows())
+        score_counts, cursors = load_score_counts()
+        user_repository.clear()
+        token_cache.clear()
+        for watched in self._watched:
+            watched[2] = None
+            watched[3] = cursors[watched[0]]
+        self.resyncs += 1
+        data_version.bump()
+        leaderboard_stream.notify()
+
+    def prune(self):
+        for _, conn, _, _ in self._watched:
+            conn.execute("DELETE FROM cache_events WHERE created_at < ?", (time.time() - self.ttl,))
+            conn.commit()
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join()
+        for _, conn, _, _ in self._watched:
+            conn.close()
+
+pool: Optional[ConnectionPool] = None
+user_repository: Optional[UserRepository] = None
+leaderboard: Optional[LeaderboardIndex] = None
+score_counts: Optional[ScoreCounts] = None
+score_writer: Optional[ScoreWriter] = None
+account_purger: Optional[AccountPurger] = None
+cache_sync: Optional[CacheSync] = None
+cache_event_cursors = {}
+score_compactor: Optional[ScoreCompactor] = None
+token_cache = TokenCache()
+data_version = DataVersion()
+user_stats_bodies = BodyCache(USER_STATS_BODY_CACHE_SIZE)
+rate_limiter = RateLimiter({
+    "/scores": (RATE_LIMIT_SCORES_RATE, RATE_LIMIT_SCORES_BURST),
+    "/scores/batch": (RATE_LIMIT_SCORES_BATCH_RATE, RATE_LIMIT_SCORES_BATCH_BURST),
+})
+leaderboard_stream = LeaderboardStream()
+db_executor: Optional[ThreadPoolExecutor] = None
+password_hasher: Optional[PasswordHasher] = None
+shard_pools: List[ConnectionPool] = []
+shard_executor: Optional[ThreadPoolExecutor] = None
+
+def shard_file(index):
+    base, ext = os.path.splitext(DATABASE_FILE)
+    return f"{base}.shard{index}{ext or '.db'}"
+
+def open_shard(index):
+    shard = ConnectionPool(shard_file(index))
+    with shard.connection() as conn:
+        migrate(conn)
+        # Число шардов записывается в файл: с другим SCORE_SHARDS игроки
+        # искались бы не в своих шардах
+        shards = conn.execute("PRAGMA user_version").fetchone()[0]
+        if shards == 0:
+            conn.execute(f"PRAGMA user_version = {SCORE_SHARDS}")
+        elif shards != SCORE_SHARDS:
+            shard.close()
+            raise RuntimeError(
+                f"{shard_file(index)} belongs to {shards} shards, but SCORE_SHARDS={SCORE_SHARDS}"
+            )
+    return shard
+
+def score_pool(user_id):
+    # База, в которой лежат результаты и агрегаты игрока
+    return shard_pools[user_id % len(shard_pools)] if shard_pools else pool
+
+def score_pools():
+    return shard_pools or [pool]
+
+def load_leaderboard_rows():
+    if not shard_pools:
+        with pool.connection() as conn, timed_query("leaderboard_build"):
+            return conn.execute('''
+                SELECT u.id, u.username, a.best_score
+                FROM user_aggregates a
+                JOIN users u ON a.user_id = u.id
+            ''').fetchall()
+
+    # Шарды: лучшие результаты из каждого шарда, имена - из основной базы
+    with pool.connection() as conn:
+        usernames = dict(conn.execute("SELECT id, username FROM users"))
+    rows = []
+    for shard in shard_pools:
+        with shard.connection() as conn, timed_query("leaderboard_build"):
+            for user_id, best_score in conn.execute("SELECT user_id, best_score FROM user_aggregates"):
+                if user_id in usernames:
+                    rows.append((user_id, usernames[user_id], best_score))
+    return rows
+
+def cache_event_cursor(conn):
+    # Последний выданный id события (sqlite_sequence не уменьшается при удалении старых)
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'cache_events'").fetchone()
+    return row[0] if row else 0
+
+def load_score_counts():
+    # Единственный проход по scores (покрывающий индекс idx_scores_score) - при запуске;
+    # дальше счётчики обновляются при каждой записи. Вместе со счётчиками из того же
+    # снимка берётся номер последнего события cache_events каждого файла
+    counts = ScoreCounts()
+    cursors = {}
+    for database in [pool] + shard_pools:
+        with database.connection() as conn, timed_query("score_counts_build"):
+            conn.execute("BEGIN")
+            cursors[database.database] = cache_event_cursor(conn)
+            if database not in score_pools():
+                conn.rollback()
+                continue
+            for score, count in conn.execute("SELECT score, COUNT(*) FROM scores GROUP BY score"):
+                counts.add(score, count)
+            for score, count in conn.execute("SELECT score, SUM(games) FROM compacted_scores GROUP BY score"):
+                counts.add(score, count)
+            conn.rollback()
+    return counts, cursors
+
+SHARDED_TABLES = ["scores", "score_daily", "compacted_scores", "account_purges"]
+
+def main_has_scores(conn):
+    return any(
+        conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+        for table in SHARDED_TABLES[:3]
+    )
+
+def check_shard_layout(conn, resharding=False):
+    if SCORE_SHARDS > SCORE_SHARDS_MAX:
+        raise RuntimeError(f"SCORE_SHARDS={SCORE_SHARDS} is above the limit of {SCORE_SHARDS_MAX}")
+    # Число шардов записывается и в DATABASE_FILE (PRAGMA user_version): сервер с другим
+    # SCORE_SHARDS не запустится и не покажет пустые таблицы вместо существующих результатов
+    layout = conn.execute("PRAGMA user_version").fetchone()[0]
+    if layout == 0:
+        # База создана до записи раскладки: её подсказывают файлы шардов и данные в основном файле
+        if os.path.exists(shard_file(0)):
+            with sqlite3.connect(shard_file(0)) as shard:
+                layout = shard.execute("PRAGMA user_version").fetchone()[0]
+            shard.close()
+        elif main_has_scores(conn):
+            layout = 1
+        else:
+            layout = SCORE_SHARDS
+        conn.execute(f"PRAGMA user_version = {layout}")
+    if resharding:
+        if layout not in (1, SCORE_SHARDS):
+            raise RuntimeError(f"{DATABASE_FILE} is split into {layout} shards; resharding to "
+                               f"SCORE_SHARDS={SCORE_SHARDS} is not supported")
+        return
+    if layout != SCORE_SHARDS:
+        hint = " - run `python server.py reshard` to move them" if layout == 1 else ""
+        raise RuntimeError(f"{DATABASE_FILE} holds scores for {layout} shard(s), "
+                           f"but SCORE_SHARDS={SCORE_SHARDS}{hint}")
+    if SCORE_SHARDS > 1 and main_has_scores(conn):
+        # Перенос прервался: часть результатов ещё в основном файле
+        raise RuntimeError(
+            f"{DATABASE_FILE} still holds scores - run `python server.py reshard` to finish moving them"
+        )
+
+def init_database(resharding=False):
+    global pool, user_repository, leaderboard, score_counts, cache_event_cursors, shard_pools
+    if pool is None:
+        pool = ConnectionPool(DATABASE_FILE)
+        try:
+            with pool.connection() as conn:
+                migrate(conn)
+                check_shard_layout(conn, resharding)
+        except RuntimeError:
+            pool.close()
+            pool = None
+            raise
+        if SCORE_SHARDS > 1:
+            shard_pools = [open_shard(index) for index in range(SCORE_SHARDS)]
+        leaderboard = LeaderboardIndex()
+        leaderboard.build(load_leaderboard_rows())
+        score_counts, cache_event_cursors = load_score_counts()
+        user_repository = UserRepository(pool)
+
+@app.on_event("startup")
+def startup():
+    global score_writer, account_purger, score_compactor, cache_sync, db_executor, password_hasher, shard_executor
+    init_database()
+    if db_executor is None:
+        db_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="db")
+    if shard_pools and shard_executor is None:
+        # Параллельное чтение шардов для /user-stats (scatter-gather)
+        shard_executor = ThreadPoolExecutor(
+            max_workers=max(DB_MAX_WORKERS, len(shard_pools)), thread_name_prefix="shard"
+        )
+    if password_hasher is None:
+        password_hasher = PasswordHasher()
+    if SCORE_WRITE_MODE == "queue" and score_writer is None:
+        score_writer = ScoreWriter()
+    if account_purger is None:
+        account_purger = AccountPurger()
+    if RETENTION_DAYS > 0 and score_compactor is None:
+        score_compactor = ScoreCompactor()
+        score_compactor.start()
+    if SERVER_WORKERS > 1 and cache_sync is None:
+        cache_sync = CacheSync(cache_event_cursors)
 
-def save_user(user):
+@app.on_event("shutdown")
+def shutdown():
+    global pool, user_repository, leaderboard, score_counts, score_writer, db_executor, password_hasher
+    global account_purger, score_compactor, cache_sync, shard_pools, shard_executor
+    leaderboard_stream.close()
+    if cache_sync is not None:
+        cache_sync.close()
+        cache_sync = None
+    if password_hasher is not None:
+        password_hasher.close()
+        password_hasher = None
+    if score_writer is not None:
+        score_writer.close()
+        score_writer = None
+    if score_compactor is not None:
+        score_compactor.close()
+        score_compactor = None
+    if account_purger is not None:
+        account_purger.close()
+        account_purger = None
+    if db_executor is not None:
+        db_executor.shutdown(wait=True)
+        db_executor = None
+    if shard_executor is not None:
+        shard_executor.shutdown(wait=True)
+        shard_executor = None
+    for shard in shard_pools:
+        shard.close()
+    shard_pools = []
+    if pool is not None:
+        pool.close()
+        pool = None
+        user_repository = None
+        leaderboard = None
+        score_counts = None
+
+async def run_db(func, *args, timeout=None):
+    # Выполняет блокирующую работу с базой в пуле db_executor, не останавливая цикл событий.
+    # Одновременно работает не больше DB_MAX_WORKERS запросов; по истечении timeout
+    # SQLite прерывает запрос через progress handler, а клиент получает 504
+    timeout = DB_QUERY_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+
+    def call():
+        _query_deadline.value = deadline
+        try:
+            return func(*args)
+        finally:
+            _query_deadline.value = None
+
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(db_executor, call), timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Database query timed out")
+    except sqlite3.OperationalError as e:
+        if "interrupted" in str(e):
+            raise HTTPException(status_code=504, detail="Database query timed out")
+        raise
+
+async def get_user_by_id(user_id):
+    user = user_repository.cached_by_id(user_id)
+    if user is None:
+        user = await run_db(user_repository.get_by_id, user_id)
+    return user
+
+async def get_user_by_username(username):
+    user = user_repository.cached_by_username(username)
+    if user is None:
+        user = await run_db(user_repository.get_by_username, username)
+    return user
+
+async def authenticate(token):
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
+
+    user_id, generation, exp = decode_token(token)
+    if token_cache.is_revoked(user_id, generation):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
+    user = await get_user_by_id(user_id)
+    if user is None or user["token_generation"] != generation:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
+    token_cache.put(token, user_id, generation, exp)
+    return user_id
+
+# Миграции схемы: номер шага = позиция в MIGRATIONS. Каждый шаг выполняется
+# один раз в своей транзакции, применённые версии хранятся в schema_version.
+# Шаги написаны так, чтобы их можно было применить и к базам, созданным
+# до появления миграций (CREATE ... IF NOT EXISTS, проверка колонок)
+def migration_base_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS scores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scores_user_id ON scores(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scores_score ON scores(score)')
+
+def migration_token_generation(c):
+    c.execute("PRAGMA table_info(users)")
+    if "token_generation" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE users ADD COLUMN token_generation INTEGER NOT NULL DEFAULT 0")
+
+def migration_user_aggregates(c):
+    # Агрегаты по игрокам, которые save_score обновляет вместе с вставкой результата
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_aggregates'")
+    aggregates_missing = c.fetchone() is None
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_aggregates (
+            user_id INTEGER PRIMARY KEY,
+            games_played INTEGER NOT NULL,
+            best_score INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            last_scores TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_aggregates_best
+        ON user_aggregates(best_score DESC, user_id)
+    ''')
+    # Старая база без агрегатов - заполняем их один раз по истории
+    if aggregates_missing:
+        _rebuild_aggregates(c.connection)
+
+def migration_scores_user_created(c):
+    # Последние результаты игрока и удаление аккаунта идут по (user_id, created_at);
+    # индекс по одному user_id становится лишним префиксом
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scores_user_created ON scores(user_id, created_at)')
+    c.execute('DROP INDEX IF EXISTS idx_scores_user_id')
+
+def migration_window_best(c):
+    # Лучший результат игрока в каждой корзине окна (сутки, неделя) для /leaderboard?window=
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS window_best (
+            period TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            best_score INTEGER NOT NULL,
+            PRIMARY KEY (period, bucket, user_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_window_best_rank
+        ON window_best(period, bucket, best_score DESC, user_id)
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_window_best_user ON window_best(user_id)')
+    rebuild_window_best(c.connection)
+
+def migration_account_purges(c):
+    # Удалённые аккаунты, чьи результаты ещё не вычищены AccountPurger.
+    # Таблица живёт рядом с результатами: в DATABASE_FILE или в шарде игрока
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS account_purges (
+            user_id INTEGER PRIMARY KEY,
+            deleted_at TEXT NOT NULL
+        )
+    ''')
+
+def migration_account_tombstones(c):
+    # Отметка в account_purges остаётся навсегда (purged_at - когда вычищено):
+    # по ней insert_scores отбрасывает результаты, принятые до удаления аккаунта,
+    # но записанные уже после него. id пользователей не переиспользуются (AUTOINCREMENT)
+    c.execute("PRAGMA table_info(account_purges)")
+    if "purged_at" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE account_purges ADD COLUMN purged_at TEXT")
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_account_purges_pending
+        ON account_purges(deleted_at) WHERE purged_at IS NULL
+    ''')
+
+def migration_admin_flag(c):
+    # Права администратора - флаг учётной записи, а не имя: имя удалённого или ещё
+    # не зарегистрированного администратора может занять кто угодно
+    c.execute("PRAGMA table_info(users)")
+    if "is_admin" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE users ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0")
+
+def migration_compaction_progress(c):
+    # Граница ScoreCompactor между проходами (см. compact)
+    c.execute("CREATE TABLE IF NOT EXISTS compaction_progress (last_id INTEGER NOT NULL)")
+    c.execute("INSERT INTO compaction_progress (last_id) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM compaction_progress)")
+
+def migration_score_daily(c):
+    # Свёрнутая история: сводка игрока за сутки и число игр с каждым значением результата
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS score_daily (
+            user_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            games INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            best_score INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS compacted_scores (
+            user_id INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            games INTEGER NOT NULL,
+            PRIMARY KEY (user_id, score)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_cache_events(c):
+    # Изменения для кэшей других процессов сервера, см. CacheSync
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS cache_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            worker INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+MIGRATIONS = [
+    migration_base_tables,
+    migration_token_generation,
+    migration_user_aggregates,
+    migration_scores_user_created,
+    migration_window_best,
+    migration_account_purges,
+    migration_score_daily,
+    migration_cache_events,
+    migration_account_tombstones,
+    migration_admin_flag,
+    migration_compaction_progress,
+]
+
+def schema_version(conn):
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    if schema_version(conn) >= len(MIGRATIONS):
+        return 0
+
+    applied = 0
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        # BEGIN IMMEDIATE: несколько процессов сервера не применят один шаг дважды
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(
+                "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                (version, datetime.now().isoformat()),
+            )
+            conn.commit()
+            applied += 1
+        except Exception as e:
+            conn.rollback()
+            print(f"Error applying migration {version} ({migration.__name__}): {e}")
+            raise
+    return applied
+
+def record_cache_event(c, kind, user_id, payload=None):
+    # Пишется в транзакции самого изменения; с одним процессом событий не нужно
+    if SERVER_WORKERS > 1:
+        c.execute('''
+            INSERT INTO cache_events (worker, kind, user_id, payload, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (os.getpid(), kind, user_id, json.dumps(payload), time.time()))
+
+def parse_last_scores(value):
+    return [int(s) for s in value.split(',') if s] if value else []
+
+def insert_scores(c, user_id, items):
+    # Вставка результатов одного игрока (список (score, created_at) в хронологическом
+    # порядке) и обновление его агрегатов в одной транзакции.
+    # INSERT первым берёт блокировку записи, поэтому чтение последних результатов ниже не гоняется.
+    # Результаты удалённого аккаунта (он мог удалиться между приёмом и записью) не пишутся:
+    # проверка идёт под той же блокировкой, что и вставка. False - ничего не записано
+    c.executemany('''
+        INSERT INTO scores (user_id, score, created_at)
+        SELECT ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM account_purges WHERE user_id = ?)
+    ''', [(user_id, score, created_at, user_id) for score, created_at in items])
+    if c.rowcount <= 0:
+        return False
+    scores = [score for score, _ in items]
+    # Последние результаты - по времени игры, как в rebuild_aggregates: игра из пакета
+    # со старой отметкой времени не встаёт впереди уже записанных (idx_scores_user_created)
+    last_scores = [score for (score,) in c.execute(
+        "SELECT score FROM scores WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+        (user_id, LAST_SCORES_COUNT),
+    )]
+    c.execute('''
+        INSERT INTO user_aggregates (user_id, games_played, best_score, score_sum, last_scores)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            games_played = games_played + excluded.games_played,
+            best_score = MAX(best_score, excluded.best_score),
+            score_sum = score_sum + excluded.score_sum,
+            last_scores = excluded.last_scores
+    ''', (user_id, len(scores), max(scores), sum(scores), ",".join(map(str, last_scores))))
+
+    # Лучшие результаты в корзинах окон, куда попадает время каждой игры
+    best = {}
+    for score, created_at in items:
+        day = day_bucket(created_at)
+        for window in LEADERBOARD_WINDOWS:
+            key = (window, window_bucket(window, day))
+            best[key] = max(score, best.get(key, score))
+    c.executemany('''
+        INSERT INTO window_best (period, bucket, user_id, best_score)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(period, bucket, user_id) DO UPDATE SET
+            best_score = MAX(best_score, excluded.best_score)
+    ''', [(window, bucket, user_id, score) for (window, bucket), score in best.items()])
+    record_cache_event(c, "scores", user_id, scores)
+    return True
+
+def day_bucket(created_at):
+    # Номер суток (UTC) от 1970-01-01. Время без часового пояса считается UTC, как в SQLite
+    moment = datetime.fromisoformat(created_at)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return (moment - UNIX_EPOCH).days
+
+def window_bucket(window, day):
+    # Неделя начинается с понедельника (1970-01-01 - четверг)
+    return day if window == "day" else (day + 3) // 7
+
+def current_bucket(window):
+    return window_bucket(window, (datetime.now(timezone.utc) - UNIX_EPOCH).days)
+
+def score_time(timestamp, now):
+    # Время игры, присланное клиентом (unix time), либо время сервера
+    if timestamp is None:
+        return now.isoformat()
+    now_ts = now.timestamp()
+    if not now_ts - SCORE_TIMESTAMP_MAX_AGE <= timestamp <= now_ts + SCORE_TIMESTAMP_MAX_SKEW:
+        raise ValueError("Timestamp is out of the accepted range")
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+def rebuild_aggregates(conn):
+    with timed_query("aggregates_rebuild"):
+        players = _rebuild_aggregates(conn)
+        rebuild_window_best(conn)
+        return players
+
+def has_table(conn, name):
+    # Пересборка вызывается и из ранних миграций, когда поздних таблиц ещё нет
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+def rebuild_window_best(conn):
+    # Корзины считаются той же функцией day_bucket, что и при вставке:
+    # julianday() в SQLite округляет время до миллисекунд и мог бы разойтись на границе суток
+    conn.create_function("day_bucket", 1, day_bucket, deterministic=True)
+    history = "SELECT user_id, score, day_bucket(created_at) AS day FROM scores"
+    if has_table(conn, "score_daily"):
+        history += " UNION ALL SELECT user_id, best_score, day FROM score_daily"
+    c = conn.cursor()
+    c.execute("DELETE FROM window_best")
+    c.execute(f'''
+        INSERT INTO window_best (period, bucket, user_id, best_score)
+        SELECT 'day', day, user_id, MAX(score)
+        FROM ({history})
+        GROUP BY day, user_id
+    ''')
+    c.execute('''
+        INSERT INTO window_best (period, bucket, user_id, best_score)
+        SELECT 'week', (bucket + 3) / 7 AS week, user_id, MAX(best_score)
+        FROM window_best
+        WHERE period = 'day'
+        GROUP BY week, user_id
+    ''')
+
+def _rebuild_aggregates(conn):
+    # Свёрнутые сутки (score_daily) входят в число игр, сумму и лучший результат;
+    # последние результаты всегда остаются в scores
+    history = "SELECT user_id, COUNT(*) AS games, MAX(score) AS best, SUM(score) AS total FROM scores GROUP BY user_id"
+    if has_table(conn, "score_daily"):
+        history += " UNION ALL SELECT user_id, games, best_score, score_sum FROM score_daily"
+    c = conn.cursor()
+    c.execute("DELETE FROM user_aggregates")
+    c.execute(f'''
+        INSERT INTO user_aggregates (user_id, games_played, best_score, score_sum, last_scores)
+        SELECT user_id, SUM(games), MAX(best), SUM(total), ''
+        FROM ({history})
+        GROUP BY user_id
+    ''')
+    c.execute('''
+        WITH LastScores AS (
+            SELECT
+                user_id,
+                score,
+                ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC, id DESC) as rn
+            FROM scores
+        )
+        SELECT user_id, GROUP_CONCAT(score)
+        FROM (SELECT user_id, score FROM LastScores WHERE rn <= ? ORDER BY user_id, rn)
+        GROUP BY user_id
+    ''', (LAST_SCORES_COUNT,))
+    c.executemany(
+        "UPDATE user_aggregates SET last_scores = ? WHERE user_id = ?",
+        [(last_scores, user_id) for user_id, last_scores in c.fetchall()],
+    )
+    return c.execute("SELECT COUNT(*) FROM user_aggregates").fetchone()[0]
+
+def save_user(conn, user):
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
         c = conn.cursor()
         c.execute('''
             INSERT INTO users (username, password, created_at)
             VALUES (?, ?, ?)
         ''', (user["username"], user["password"], user["created_at"]))
         conn.commit()
+        return c.lastrowid
     except Exception as e:
         print(f"Error saving user: {e}")
         raise e
-    finally:
-        conn.close()
 
 @app.post("/register", response_model=UserOut)
 async def register(user: UserCreate):
     try:
-        create_tables()
-        users = load_database()
-
         if not user.username or not user.password:
             raise HTTPException(status_code=400, detail="Username and password are required")
 
@@ -155,42 +2220,39 @@ async def register(user: UserCreate):
         if len(user.password) < 4:
             raise HTTPException(status_code=400, detail="Password must be at least 4 characters long")
 
-        if any(u["username"] == user.username for u in users):
+        if await get_user_by_username(user.username) is not None:
             raise HTTPException(status_code=400, detail="Username already exists")
 
-        new_user = {
-            "id": None,
-            "username": user.username,
-            "password": hash_password(user.password),
-            "created_at": datetime.utcnow().isoformat(),
-        }
-
-        save_user(new_user)
-
-        # Получение ID нового пользователя
-        conn = sqlite3.connect(DATABASE_FILE)
-        c = conn.cursor()
-        c.execute("SELECT last_insert_rowid()")
-        new_user["id"] = c.fetchone()[0]
-        conn.close()
+        try:
+            password_hash = await password_hasher.hash(user.password)
+            new_user = await run_db(user_repository.create, user.username, password_hash)
+        except sqlite3.IntegrityError:
+            # Имя заняли параллельным запросом между проверкой и вставкой
+            raise HTTPException(status_code=400, detail="Username already exists")
 
         return UserOut(
             id=new_user["id"],
             username=new_user["username"],
-            created_at=datetime.fromisoformat(new_user["created_at"]),
+            created_at=new_user["created_at"],
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/login")
 async def login(user: UserCreate):
-    users = load_database()
-    db_user = next((u for u in users if u["username"] == user.username), None)
+    db_user = await get_user_by_username(user.username)
     
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    if not db_user or not await password_hasher.verify(user.password, db_user["password"]):
         raise HTTPException(status_code=401, detail="Incorrect username or password")
 
-    token = create_token(db_user["id"])
+    # Прозрачно переводим старые sha256-хэши (и хэши с другой стоимостью) на текущий KDF
+    if password_needs_rehash(db_user["password"]):
+        new_hashed = await password_hasher.hash(user.password)
+        await run_db(user_repository.replace_password, db_user["id"], db_user["password"], new_hashed)
+
+    token = create_token(db_user["id"], db_user["token_generation"])
     return {"token": token, "success": True}
 
 @app.get("/me", response_model=UserOut)
@@ -203,10 +2265,9 @@ async def me(authorization: Optional[str] = Header(None)):
 
     try:
         token = authorization.split(" ")[1]
-        user_id = verify_token(token)
+        user_id = await authenticate(token)
         
-        users = load_database()
-        user = next((u for u in users if u["id"] == user_id), None)
+        user = await get_user_by_id(user_id)
         
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
@@ -217,14 +2278,23 @@ async def me(authorization: Optional[str] = Header(None)):
         elif not isinstance(created_at, datetime):
             created_at = datetime.utcnow()
 
-        return UserOut(
-            id=user["id"],
-            username=user["username"],
-            created_at=created_at,
-        )
+        # Тело собирается напрямую, без построения и проверки модели UserOut
+        return FastJSONResponse({
+            "id": user["id"],
+            "username": user["username"],
+            "created_at": created_at.isoformat(),
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def write_scores(user_id, items):
+    with score_pool(user_id).connection() as conn, timed_query("score_insert"):
+        written = insert_scores(conn.cursor(), user_id, items)
+        conn.commit()
+    return written
+
 @app.post("/scores")
 async def save_score(score_data: ScoreCreate, authorization: Optional[str] = Header(None)):
     if not authorization:
@@ -235,61 +2305,251 @@ async def save_score(score_data: ScoreCreate, authorization: Optional[str] = Hea
             raise HTTPException(status_code=401, detail="Invalid authorization format")
         
         token = authorization.split(" ")[1]
-        user_id = verify_token(token)
-        
-        conn = sqlite3.connect(DATABASE_FILE)
-        c = conn.cursor()
+        user_id = await authenticate(token)
+        rate_limiter.limit("/scores", user_id)
+        current_time = datetime.now(timezone.utc).isoformat()
+
+        # Режим очереди: подтверждаем приём, запись сделает фоновый писатель
+        if score_writer is not None:
+            if not score_writer.submit(user_id, score_data.score, current_time):
+                raise HTTPException(
+                    status_code=503,
+                    detail="Score queue is full, try again later",
+                    headers={"Retry-After": "1"},
+                )
+            return {"success": True, "queued": True}
         
         # Сохраняем каждый результат игры
-        current_time = datetime.now(timezone.utc).isoformat()
-        c.execute('''
-            INSERT INTO scores (user_id, score, created_at)
-            VALUES (?, ?, ?)
-        ''', (user_id, score_data.score, current_time))
-            
-        conn.commit()
+        if not await run_db(write_scores, user_id, [(score_data.score, current_time)]):
+            # Аккаунт удалили, пока запрос был в пути
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
+        score_counts.add(score_data.score)
+
+        user = await get_user_by_id(user_id)
+        if user is not None and leaderboard.record(user_id, user["username"], score_data.score):
+            leaderboard_stream.notify()
+        data_version.bump()
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
-@app.get("/leaderboard")
-async def get_leaderboard():
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-    
+def parse_percentiles(value):
     try:
-        # Получение лучших результатов каждого игрока
-        c.execute('''
-            WITH RankedScores AS (
-                SELECT 
-                    u.username,
-                    s.score,
-                    ROW_NUMBER() OVER (PARTITION BY u.id ORDER BY s.score DESC) as rn
-                FROM scores s
-                JOIN users u ON s.user_id = u.id
-            )
-            SELECT username, score
-            FROM RankedScores
-            WHERE rn = 1
-            ORDER BY score DESC
-            LIMIT 3
-        ''')
-        rows = c.fetchall()
-        
+        percentiles = sorted({float(p) for p in value.split(",") if p.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid percentiles")
+    if not percentiles or not all(0 < p <= 100 for p in percentiles):
+        raise HTTPException(status_code=400, detail="Percentiles must be in (0, 100]")
+    return percentiles
+
+@app.get("/scores/distribution")
+async def get_score_distribution(
+    response: Response,
+    percentiles: str = Query(DISTRIBUTION_PERCENTILES),
+    bucket_size: int = Query(DISTRIBUTION_BUCKET_SIZE, ge=1, le=SCORE_DISTRIBUTION_MAX + 1),
+    if_none_match: Optional[str] = Header(None),
+):
+    # Все игры и лучшие результаты игроков - из счётчиков в памяти, без обращения к базе
+    percentiles = parse_percentiles(percentiles)
+    etag = data_version.etag()
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    response.headers.update(cache_headers(etag))
+    return {
+        "games": score_counts.summary(percentiles, bucket_size),
+        "best": leaderboard.bests.summary(percentiles, bucket_size),
+    }
+
+@app.get("/scores/queue")
+async def get_score_queue():
+    if score_writer is None:
+        return {"enabled": False}
+    return {"enabled": True, **score_writer.metrics()}
+
+@app.post("/scores/batch")
+async def save_scores_batch(items: List[Any] = Body(...), authorization: Optional[str] = Header(None)):
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Authorization header missing")
+
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid authorization format")
+
+    if len(items) > SCORE_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"Batch is limited to {SCORE_BATCH_MAX_SIZE} scores"
+        )
+
+    try:
+        token = authorization.split(" ")[1]
+        user_id = await authenticate(token)
+        rate_limiter.limit("/scores/batch", user_id)
+
+        # Проверяем весь пакет до записи; ошибочные элементы не мешают остальным
+        now = datetime.now(timezone.utc)
         results = []
-        for i, (username, score) in enumerate(rows, 1):
-            results.append({
-                "position": i,
-                "username": username,
-                "score": score
-            })
-        
-        return results
-    finally:
-        conn.close()
+        accepted = []
+        for index, item in enumerate(items):
+            try:
+                if not isinstance(item, dict):
+                    raise ValueError("Score item must be an object")
+                score_data = ScoreCreate(**item)
+                created_at = score_time(score_data.timestamp, now)
+            except (ValidationError, ValueError) as e:
+                detail = e.errors()[0]["msg"] if isinstance(e, ValidationError) else str(e)
+                results.append({"index": index, "status": "error", "detail": detail})
+                continue
+            accepted.append((created_at, index, score_data.score))
+            results.append({"index": index, "status": "ok"})
+
+        if accepted:
+            accepted.sort()
+            rows = [(score, created_at) for created_at, _, score in accepted]
+            if not await run_db(write_scores, user_id, rows):
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
+            for _, _, score in accepted:
+                score_counts.add(score)
+
+            user = await get_user_by_id(user_id)
+            best = max(score for _, _, score in accepted)
+            if user is not None and leaderboard.record(user_id, user["username"], best):
+                leaderboard_stream.notify()
+            data_version.bump()
+
+        return {
+            "success": len(accepted) == len(items),
+            "accepted": len(accepted),
+            "rejected": len(items) - len(accepted),
+            "results": results
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def cache_headers(etag):
+    # no-cache: клиент хранит ответ, но перед использованием сверяет ETag
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+def fetch_window_leaderboard(window, bucket, limit):
+    # Топ корзины по индексу idx_window_best_rank: время не зависит от объёма истории.
+    # С шардами - топ каждого шарда и слияние
+    pages = []
+    for scores_pool in score_pools():
+        with scores_pool.connection() as conn, timed_query("leaderboard_window"):
+            pages.append(conn.execute('''
+                SELECT user_id, best_score
+                FROM window_best
+                WHERE period = ? AND bucket = ?
+                  AND user_id NOT IN (SELECT user_id FROM account_purges WHERE purged_at IS NULL)
+                ORDER BY best_score DESC, user_id
+                LIMIT ?
+            ''', (window, bucket, limit)).fetchall())
+    rows = list(islice(heapq.merge(*pages, key=lambda row: (-row[1], row[0])), limit))
+    if not rows:
+        return []
+    usernames = fetch_usernames([user_id for user_id, _ in rows])
+    return [(usernames[user_id], score) for user_id, score in rows if user_id in usernames]
+
+@app.get("/leaderboard")
+async def get_leaderboard(
+    limit: int = Query(LEADERBOARD_SIZE, ge=1, le=LEADERBOARD_MAX_SIZE),
+    window: str = Query("all", pattern="^(day|week|all)$"),
+    if_none_match: Optional[str] = Header(None),
+):
+    # Версия берётся до чтения данных: при гонке с записью ответ может оказаться
+    # новее своего ETag, но не старее. Для окон в ETag входит номер корзины:
+    # с наступлением новых суток ответ меняется без всякой записи
+    bucket = None if window == "all" else current_bucket(window)
+    etag = data_version.etag("" if bucket is None else f"{window}{bucket}")
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+
+    if bucket is None:
+        # Ответ берётся из индекса в памяти уже закодированным, без обращения к базе
+        return json_body_response(leaderboard.top_json(limit), cache_headers(etag))
+
+    rows = await run_db(fetch_window_leaderboard, window, bucket, limit)
+    return FastJSONResponse([
+        {"position": position, "username": username, "score": score}
+        for position, (username, score) in enumerate(rows, 1)
+    ], headers=cache_headers(etag))
+
+def player_rank(user_id, neighbours):
+    rank = leaderboard.rank(user_id, neighbours)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="Player has no scores yet")
+    return rank
+
+@app.get("/rank/me")
+async def get_my_rank(
+    neighbours: int = Query(RANK_NEIGHBOURS, ge=0, le=RANK_MAX_NEIGHBOURS),
+    authorization: Optional[str] = Header(None),
+):
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Authorization header missing")
+
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid authorization format")
+
+    token = authorization.split(" ")[1]
+    user_id = await authenticate(token)
+    return player_rank(user_id, neighbours)
+
+@app.get("/rank/{username}")
+async def get_rank(username: str, neighbours: int = Query(RANK_NEIGHBOURS, ge=0, le=RANK_MAX_NEIGHBOURS)):
+    user = await get_user_by_username(username)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return player_rank(user["id"], neighbours)
+
+@app.get("/leaderboard/stream")
+async def stream_leaderboard():
+    # Server-Sent Events: сначала снимок топа (event: snapshot), затем только
+    # изменившиеся позиции (event: diff) после того, как рейтинг действительно изменился.
+    # Подписка - внутри генератора: если клиент ушёл до начала ответа, генератор
+    # не запускается и очередь не остаётся в подписчиках
+    async def events():
+        subscriber = leaderboard_stream.subscribe()
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.get(), LEADERBOARD_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    message = ": keepalive\n\n"
+                if message is None:
+                    break
+                yield message
+        finally:
+            leaderboard_stream.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+def update_password(user_id, current_hashed, new_hashed):
+    with pool.connection() as conn, timed_query("password_update"):
+        c = conn.cursor()
+        # Сравнение со старым хэшем защищает от параллельной смены пароля
+        c.execute(
+            "UPDATE users SET password = ?, token_generation = token_generation + 1 "
+            "WHERE id = ? AND password = ?",
+            (new_hashed, user_id, current_hashed)
+        )
+        if c.rowcount != 1:
+            raise HTTPException(status_code=409, detail="Password was changed concurrently")
+        c.execute("SELECT token_generation FROM users WHERE id = ?", (user_id,))
+        generation = c.fetchone()[0]
+        record_cache_event(c, "password", user_id, generation)
+        conn.commit()
+        return generation
 
 @app.patch("/change-password")
 async def change_password(password_data: PasswordChange, authorization: Optional[str] = Header(None)):
@@ -301,114 +2561,267 @@ async def change_password(password_data: PasswordChange, authorization: Optional
 
     try:
         token = authorization.split(" ")[1]
-        user_id = verify_token(token)
-        
-        conn = sqlite3.connect(DATABASE_FILE)
-        c = conn.cursor()
+        user_id = await authenticate(token)
         
-        c.execute("SELECT password FROM users WHERE id = ?", (user_id,))
-        result = c.fetchone()
-        if not result:
+        user = await get_user_by_id(user_id)
+        if not user:
             raise HTTPException(status_code=404, detail="User not found")
-        
-        current_hashed = result[0]
-        
-        if not verify_password(password_data.current_password, current_hashed):
+
+        if not await password_hasher.verify(password_data.current_password, user["password"]):
             raise HTTPException(status_code=400, detail="Current password is incorrect")
-        
-        new_hashed = hash_password(password_data.new_password)
-        c.execute(
-            "UPDATE users SET password = ? WHERE id = ?",
-            (new_hashed, user_id)
-        )
-        conn.commit()
-        
-        return {"message": "Password successfully changed"}
-        
+
+        new_hashed = await password_hasher.hash(password_data.new_password)
+        generation = await run_db(update_password, user_id, user["password"], new_hashed)
+        user_repository.invalidate(user_id)
+        # Старые токены больше не действуют, клиент получает новый
+        token_cache.revoke(user_id, generation)
+
+        return {
+            "message": "Password successfully changed",
+            "token": create_token(user_id, generation)
+        }
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+def encode_cursor(best_score, user_id):
+    raw = f"{best_score}:{user_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        best_score, user_id = raw.split(":")
+        return int(best_score), int(user_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def stats_page_query(select, join, after, limit):
+    # Keyset-пагинация по (best_score DESC, user_id) - идёт по индексу idx_user_aggregates_best.
+    # Отдельное условие best_score <= ? даёт планировщику границу для поиска по индексу:
+    # без него страница из середины списка просматривает индекс с самого начала
+    query = f"SELECT {select} FROM user_aggregates a {join}"
+    params = []
+    if after is not None:
+        query += " WHERE a.best_score <= ? AND (a.best_score < ? OR a.user_id > ?)"
+        params = [after[0], after[0], after[1]]
+    query += " ORDER BY a.best_score DESC, a.user_id LIMIT ?"
+    params.append(limit)
+    return query, params
+
+def fetch_user_stats_page(after, limit):
+    if shard_pools:
+        return fetch_sharded_stats_page(after, limit)
+
+    query, params = stats_page_query(
+        "a.user_id, u.username, a.games_played, a.best_score, a.score_sum, a.last_scores",
+        "JOIN users u ON a.user_id = u.id", after, limit,
+    )
+    with pool.connection() as conn, timed_query("user_stats_page"):
+        return conn.execute(query, params).fetchall()
+
+def fetch_usernames(user_ids):
+    with pool.connection() as conn, timed_query("usernames"):
+        return dict(conn.execute(
+            f"SELECT id, username FROM users WHERE id IN ({','.join('?' * len(user_ids))})",
+            list(user_ids),
+        ))
+
+def fetch_shard_stats_page(shard, query, params, deadline):
+    # Выполняется в потоке shard_executor: срок запроса передаётся явно
+    _query_deadline.value = deadline
+    try:
+        with shard.connection() as conn, timed_query("user_stats_shard_page"):
+            return conn.execute(query, params).fetchall()
     finally:
-        if 'conn' in locals():
-            conn.close()
+        _query_deadline.value = None
+
+def fetch_sharded_stats_page(after, limit):
+    # Scatter-gather: каждый шард параллельно отдаёт свою страницу после курсора,
+    # страницы сливаются по (best_score DESC, user_id) и обрезаются до limit
+    query, params = stats_page_query(
+        "a.user_id, a.games_played, a.best_score, a.score_sum, a.last_scores", "", after, limit
+    )
+    deadline = getattr(_query_deadline, "value", None)
+    run = shard_executor.map if shard_executor is not None else map
+    pages = list(run(lambda shard: fetch_shard_stats_page(shard, query, params, deadline), shard_pools))
+    rows = list(islice(heapq.merge(*pages, key=lambda row: (-row[2], row[0])), limit))
+    if not rows:
+        return []
+
+    usernames = fetch_usernames([row[0] for row in rows])
+    return [
+        (user_id, usernames[user_id], games_played, best_score, score_sum, last_scores)
+        for user_id, games_played, best_score, score_sum, last_scores in rows
+        if user_id in usernames
+    ]
+
+def player_stats(row):
+    _, username, games_played, best_score, score_sum, last_scores = row
+    return {
+        "username": username,
+        "games_played": games_played,
+        "best_score": best_score,
+        "average_score": round(score_sum / games_played, 1),
+        "last_scores": parse_last_scores(last_scores)
+    }
+
+def user_stats_page(rows, after, page_size):
+    if not rows and after is None:
+        return {
+            "players": [],
+            "next_cursor": None,
+            "message": "Нет данных о играх"
+        }
+
+    next_cursor = None
+    if len(rows) == page_size:
+        next_cursor = encode_cursor(rows[-1][3], rows[-1][0])
+
+    return {
+        "players": [player_stats(row) for row in rows],
+        "next_cursor": next_cursor
+    }
+
+def stats_chunk_size(remaining):
+    return USER_STATS_PAGE_SIZE if remaining is None else min(remaining, USER_STATS_PAGE_SIZE)
+
+async def stream_user_stats(after, limit, rows):
+    # Читаем порциями через run_db: тот же предел одновременных запросов и срок
+    # на каждую порцию, соединение занято только на время одной порции.
+    # Первая порция читается до начала ответа, чтобы ошибка дошла до клиента статусом
+    remaining = limit
+    while True:
+        chunk = stats_chunk_size(remaining)
+        for row in rows:
+            yield json.dumps(player_stats(row), ensure_ascii=False) + "\n"
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < chunk or remaining == 0:
+            return
+        after = (rows[-1][3], rows[-1][0])
+        rows = await run_db(fetch_user_stats_page, after, stats_chunk_size(remaining))
 
 @app.get("/user-stats", response_model=dict)
-async def get_user_stats():
+async def get_user_stats(
+    limit: Optional[int] = Query(None, ge=1, le=USER_STATS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    if_none_match: Optional[str] = Header(None),
+):
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        c = conn.cursor()
-        
-        # Получаем полную статистику по каждому игроку
-        c.execute("""
-            WITH PlayerStats AS (
-                SELECT 
-                    u.username,
-                    COUNT(*) as games_played,
-                    MAX(s.score) as best_score,
-                    AVG(s.score) as avg_score
-                FROM users u
-                JOIN scores s ON u.id = s.user_id
-                GROUP BY u.id, u.username
-            ),
-            LastScores AS (
-                SELECT 
-                    u.username,
-                    s.score,
-                    s.created_at,
-                    ROW_NUMBER() OVER (PARTITION BY u.id ORDER BY s.created_at DESC) as rn
-                FROM users u
-                JOIN scores s ON u.id = s.user_id
+        after = decode_cursor(cursor) if cursor else None
+
+        # Данные не менялись - отвечаем 304, не обращаясь к базе
+        etag = data_version.etag()
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
+
+        # NDJSON: строки отдаются по мере чтения, без сборки всего ответа в памяти
+        if format == "ndjson":
+            rows = await run_db(fetch_user_stats_page, after, stats_chunk_size(limit))
+            return StreamingResponse(
+                stream_user_stats(after, limit, rows),
+                media_type="application/x-ndjson",
+                headers=cache_headers(etag),
             )
-            SELECT 
-                p.username,
-                p.games_played,
-                p.best_score,
-                ROUND(p.avg_score, 1) as avg_score,
-                GROUP_CONCAT(
-                    CASE WHEN l.rn <= 5 THEN l.score END
-                ) as last_five_scores
-            FROM PlayerStats p
-            LEFT JOIN LastScores l ON p.username = l.username
-            GROUP BY 
-                p.username, 
-                p.games_played, 
-                p.best_score, 
-                p.avg_score
-            ORDER BY p.best_score DESC
-        """)
-        
-        rows = c.fetchall()
-        
-        if not rows:
-            return {
-                "players": [],
-                "message": "Нет данных о играх"
-            }
-        
-        players_stats = []
-        for username, games_played, best_score, avg_score, last_scores in rows:
-            # Преобразуем строку последних результатов в список
-            last_scores_list = []
-            if last_scores:
-                last_scores_list = [int(s) for s in last_scores.split(',') if s][:5]
-            
-            players_stats.append({
-                "username": username,
-                "games_played": games_played,
-                "best_score": best_score,
-                "average_score": float(avg_score),
-                "last_scores": last_scores_list
-            })
-        
-        return {
-            "players": players_stats
-        }
-        
+
+        # Пока версия данных та же, страница отдаётся из кэша готовых тел
+        page_size = limit or USER_STATS_PAGE_SIZE
+        body = user_stats_bodies.get(etag, (after, page_size))
+        if body is None:
+            rows = await run_db(fetch_user_stats_page, after, page_size)
+            body = encode_json(user_stats_page(rows, after, page_size))
+            user_stats_bodies.put(etag, (after, page_size), body)
+        return json_body_response(body, cache_headers(etag))
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in get_user_stats: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+def delete_user(user_id):
+    # Время не зависит от истории игрока: удаляются только агрегаты и сам пользователь,
+    # результаты помечаются в account_purges и вычищаются AccountPurger в фоне
+    with score_pool(user_id).connection() as conn, timed_query("user_delete"):
+        c = conn.cursor()
+
+        c.execute(
+            "INSERT OR IGNORE INTO account_purges (user_id, deleted_at) VALUES (?, ?)",
+            (user_id, datetime.now(timezone.utc).isoformat()),
+        )
+        c.execute("DELETE FROM user_aggregates WHERE user_id = ?", (user_id,))
+
+        # Удаляем самого пользователя
+        if not shard_pools:
+            c.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            record_cache_event(c, "delete", user_id)
+
+        conn.commit()
+
+    # С шардами пользователь удаляется из основной базы после своих результатов:
+    # сбой между шагами не оставит агрегатов без владельца
+    if shard_pools:
+        with pool.connection() as conn, timed_query("user_delete"):
+            conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            record_cache_event(conn, "delete", user_id)
+            conn.commit()
+
+def reshard():
+    # Перенос результатов из DATABASE_FILE в шарды при включении SCORE_SHARDS.
+    # Сначала в основной файл записывается новая раскладка: прерванный перенос не даст
+    # запустить сервер ни со старым, ни с новым SCORE_SHARDS, пока его не доведут до конца.
+    # Каждый шард - отдельная транзакция: шард очищается и заполняется заново из основного
+    # файла, затем его строки удаляются из основного. Повторный запуск после сбоя
+    # пропускает готовые шарды и переносит остальные без дублей
+    shards = len(shard_pools)
+    with pool.connection() as conn:
+        conn.execute(f"PRAGMA user_version = {shards}")
+    moved = 0
+    for index, shard in enumerate(shard_pools):
+        with shard.connection() as conn:
+            conn.execute("ATTACH DATABASE ? AS source", (DATABASE_FILE,))
+            try:
+                if not any(
+                    conn.execute(f"SELECT 1 FROM source.{table} WHERE user_id % ? = ? LIMIT 1",
+                                 (shards, index)).fetchone()
+                    for table in SHARDED_TABLES
+                ):
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                for table in SHARDED_TABLES:
+                    conn.execute(f"DELETE FROM {table}")
+                moved += conn.execute('''
+                    INSERT INTO scores (user_id, score, created_at)
+                    SELECT user_id, score, created_at FROM source.scores
+                    WHERE user_id % ? = ?
+                    ORDER BY id
+                ''', (shards, index)).rowcount
+                conn.execute('''
+                    INSERT INTO account_purges (user_id, deleted_at, purged_at)
+                    SELECT user_id, deleted_at, purged_at FROM source.account_purges
+                    WHERE user_id % ? = ?
+                ''', (shards, index))
+                conn.execute('''
+                    INSERT INTO score_daily SELECT * FROM source.score_daily WHERE user_id % ? = ?
+                ''', (shards, index))
+                conn.execute('''
+                    INSERT INTO compacted_scores SELECT * FROM source.compacted_scores WHERE user_id % ? = ?
+                ''', (shards, index))
+                rebuild_aggregates(conn)
+                conn.commit()
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute("DETACH DATABASE source")
+        with pool.connection() as conn:
+            for table in SHARDED_TABLES + ["user_aggregates", "window_best"]:
+                conn.execute(f"DELETE FROM {table} WHERE user_id % ? = ?", (shards, index))
+            conn.commit()
+    return moved
 
 @app.delete("/delete-account")
 async def delete_account(authorization: Optional[str] = Header(None)):
@@ -420,27 +2833,218 @@ async def delete_account(authorization: Optional[str] = Header(None)):
 
     try:
         token = authorization.split(" ")[1]
-        user_id = verify_token(token)
-        
-        conn = sqlite3.connect(DATABASE_FILE)
-        c = conn.cursor()
-        
-        # Удаляем все результаты пользователя
-        c.execute("DELETE FROM scores WHERE user_id = ?", (user_id,))
+        user_id = await authenticate(token)
         
-        # Удаляем самого пользователя
-        c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        
-        conn.commit()
+        await run_db(delete_user, user_id)
+        if account_purger is not None:
+            account_purger.wake()
+        user_repository.invalidate(user_id)
+        token_cache.revoke(user_id)
+        if leaderboard.remove(user_id):
+            leaderboard_stream.notify()
+        data_version.bump()
         return {"message": "Account successfully deleted"}
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+def export_chunks(conn):
+    # Сырые результаты с именами игроков порциями по EXPORT_CHUNK_SIZE строк.
+    # Свёрнутая история (score_daily) сюда не входит - её строки лежат в архиве
+    schemas = [f"shard{index}" for index in range(len(shard_pools))] or ["main"]
+    for schema in schemas:
+        cursor = conn.execute(f'''
+            SELECT s.user_id, u.username, s.score, s.created_at,
+                   CAST(strftime('%s', s.created_at) AS INTEGER)
+            FROM {schema}.scores s
+            JOIN main.users u ON u.id = s.user_id
+            ORDER BY s.id
+        ''')
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+
+def encode_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["user_id", "username", "score", "created_at"])
+    yield buffer.getvalue().encode()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(row[:4] for row in rows)
+        yield buffer.getvalue().encode()
+
+def encode_columnar(chunks):
+    # EXPORT_MAGIC, затем блоки: uint32 n и три массива по n значений int64 -
+    # user_id, score, время игры в unix time (всё little-endian). Блок с n = 0 - конец
+    yield EXPORT_MAGIC
+    for rows in chunks:
+        layout = f"<{len(rows)}q"
+        yield b"".join([
+            struct.pack("<I", len(rows)),
+            struct.pack(layout, *[row[0] for row in rows]),
+            struct.pack(layout, *[row[2] for row in rows]),
+            struct.pack(layout, *[row[4] for row in rows]),
+        ])
+    yield struct.pack("<I", 0)
+
+EXPORT_FORMATS = {
+    "csv": (encode_csv, "text/csv", "csv"),
+    "columnar": (encode_columnar, "application/octet-stream", "bin"),
+}
+
+def export_scores(format):
+    # Отдельное соединение и одна читающая транзакция на весь экспорт, пул соединений
+    # не занят. Пока экспорт идёт, checkpoint не переносит WAL дальше этого снимка
+    conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+    try:
+        shards = [f"shard{index}" for index in range(len(shard_pools))]
+        for index, schema in enumerate(shards):
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (shard_file(index),))
+        conn.execute("BEGIN")
+        # Снимок каждого файла начинается с первого чтения из него, поэтому все файлы
+        # читаются сразу, а не по ходу экспорта. Основной файл - последним: игрок любого
+        # результата из снимка шарда уже есть в снимке users и не выпадет из JOIN
+        for schema in shards + ["main"]:
+            conn.execute(f"SELECT 1 FROM {schema}.scores LIMIT 1").fetchall()
+        yield from EXPORT_FORMATS[format][0](export_chunks(conn))
     finally:
-        if 'conn' in locals():
-            conn.close()
+        conn.close()
+
+def is_admin(user_id):
+    with pool.connection() as conn:
+        row = conn.execute("SELECT is_admin FROM users WHERE id = ?", (user_id,)).fetchone()
+    return bool(row and row[0])
+
+def set_admin(username, value):
+    with pool.connection() as conn:
+        changed = conn.execute(
+            "UPDATE users SET is_admin = ? WHERE username = ?", (int(value), username)
+        ).rowcount
+        conn.commit()
+    return changed > 0
+
+@app.get("/admin/export")
+async def export(
+    format: str = Query("csv", pattern="^(csv|columnar)$"),
+    authorization: Optional[str] = Header(None),
+):
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Authorization header missing")
+
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid authorization format")
+
+    token = authorization.split(" ")[1]
+    user_id = await authenticate(token)
+    # Флаг читается из базы на каждый запрос: grant/revoke-admin действуют без перезапуска
+    if not await run_db(is_admin, user_id):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    _, media_type, extension = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        export_scores(format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="scores.{extension}"'},
+    )
+
+RUNTIME_GAUGES = [
+    Gauge("leaderboard_stream_subscribers", "Open /leaderboard/stream connections",
+          callback=lambda: len(leaderboard_stream)),
+    Gauge("score_queue_depth", "Scores waiting for the background writer",
+          callback=lambda: score_writer.metrics()["queue_depth"] if score_writer is not None else 0),
+    Gauge("password_hash_pending", "Password operations queued or running",
+          callback=lambda: password_hasher.pending if password_hasher is not None else 0),
+    Gauge("leaderboard_players", "Players in the in-memory leaderboard",
+          callback=lambda: len(leaderboard) if leaderboard is not None else 0),
+    Gauge("rate_limit_buckets", "Token buckets held by the rate limiter",
+          callback=lambda: len(rate_limiter)),
+]
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Текстовый формат Prometheus (exposition format 0.0.4)
+    lines = []
+    for metric in [HTTP_REQUEST_SECONDS, HTTP_REQUESTS_TOTAL, HTTP_REQUESTS_IN_FLIGHT,
+                   DB_QUERY_SECONDS, DB_QUERY_ERRORS, RATE_LIMITED_TOTAL] + RUNTIME_GAUGES:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    create_tables()
-    uvicorn.run(app, host="127.0.0.1", port=8001)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command", nargs="?", default="serve",
+        choices=["serve", "migrate", "rebuild-aggregates", "reshard", "vacuum", "compact", "export",
+                 "grant-admin", "revoke-admin"],
+    )
+    parser.add_argument("username", nargs="?", help="account for grant-admin / revoke-admin")
+    parser.add_argument("--format", default="csv", choices=sorted(EXPORT_FORMATS))
+    parser.add_argument("--output", default="-", help="export file, '-' for stdout")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="uvicorn worker processes")
+    args = parser.parse_args()
+
+    # Миграции схемы применяются здесь и в startup, а не в обработчиках запросов
+    init_database(resharding=args.command == "reshard")
+    if args.command == "migrate":
+        with pool.connection() as conn:
+            print(f"Schema version {schema_version(conn)} of {len(MIGRATIONS)}")
+    elif args.command == "rebuild-aggregates":
+        players = 0
+        for scores_pool in score_pools():
+            with scores_pool.connection() as conn:
+                players += rebuild_aggregates(conn)
+                conn.commit()
+        print(f"Rebuilt aggregates for {players} players")
+    elif args.command == "reshard":
+        if not shard_pools:
+            parser.error("set SCORE_SHARDS > 1 to move scores into shards")
+        print(f"Moved {reshard()} scores into {len(shard_pools)} shards")
+    elif args.command == "compact":
+        if RETENTION_DAYS <= 0:
+            parser.error("set RETENTION_DAYS > 0 to compact old scores")
+        compactor = ScoreCompactor()
+        print(f"Compacted {compactor.compact(full=True)} scores older than {RETENTION_DAYS} days "
+              f"into {compactor.archive_dir}")
+    elif args.command == "export":
+        output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        try:
+            for block in export_scores(args.format):
+                output.write(block)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+    elif args.command in ("grant-admin", "revoke-admin"):
+        if not args.username:
+            parser.error(f"{args.command} needs a username")
+        if not set_admin(args.username, args.command == "grant-admin"):
+            parser.error(f"user {args.username} not found")
+        print(f"{args.username}: admin {'granted' if args.command == 'grant-admin' else 'revoked'}")
+    elif args.command == "vacuum":
+        # Полный VACUUM переводит существующие файлы в auto_vacuum=INCREMENTAL.
+        # База заблокирована всё время работы - запускать при остановленном сервере
+        for database in [pool] + shard_pools:
+            with database.connection() as conn:
+                conn.execute("VACUUM")
+                mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            print(f"{database.database}: auto_vacuum={mode}")
+    else:
+        # Потоки /leaderboard/stream не завершаются сами - не ждём их дольше 5 секунд
+        if args.workers > 1:
+            # Процессам нужен импортируемый модуль; SERVER_WORKERS в окружении
+            # включает в них cache_events
+            os.environ["SERVER_WORKERS"] = str(args.workers)
+            uvicorn.run(
+                f"{os.path.splitext(os.path.basename(__file__))[0]}:app",
+                app_dir=os.path.dirname(os.path.abspath(__file__)),
+                host="127.0.0.1", port=8001, workers=args.workers, timeout_graceful_shutdown=5,
+            )
+        else:
+            uvicorn.run(app, host="127.0.0.1", port=8001, timeout_graceful_shutdown=5)
@@ -0,0 +1,50 @@
+import importlib.util
+import itertools
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+TEST_ENV = {
+    "PASSWORD_HASH_ITERATIONS": "1000",
+    "PASSWORD_HASH_WORKERS": "1",
+    "RATE_LIMIT_SCORES_RATE": "0",
+    "RATE_LIMIT_SCORES_BATCH_RATE": "0",
+}
+_module_ids = itertools.count()
+
+@pytest.fixture
+def load_server(tmp_path, monkeypatch):
+    # Настройки сервер читает из окружения при импорте, поэтому модуль
+    # загружается заново для каждого теста со своим файлом базы
+    def load(**env):
+        monkeypatch.setenv("DATABASE_FILE", str(tmp_path / "test.db"))
+        for key, value in {**TEST_ENV, **env}.items():
+            monkeypatch.setenv(key, str(value))
+        spec = importlib.util.spec_from_file_location(f"test_server_{next(_module_ids)}", SERVER_PATH)
+        server = importlib.util.module_from_spec(spec)
+        # Пулу процессов нужно находить функции сервера по имени модуля
+        monkeypatch.setitem(sys.modules, spec.name, server)
+        spec.loader.exec_module(server)
+        return server
+    return load
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+@pytest.fixture
+def client(server):
+    with TestClient(server.app) as client:
+        yield client
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+def register(client, username, password="secret"):
+    client.post("/register", json={"username": username, "password": password})
+    response = client.post("/login", json={"username": username, "password": password})
+    assert response.status_code == 200, response.text
+    return response.json()["token"]
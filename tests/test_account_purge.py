@@ -0,0 +1,77 @@
+import threading
+
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+TABLES = ["scores", "user_aggregates", "window_best", "score_daily", "compacted_scores"]
+
+def rows_left(server, user_id):
+    with server.pool.connection() as conn:
+        return {table: conn.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id = ?", (user_id,)).fetchone()[0]
+                for table in TABLES}
+
+def purge_all(server):
+    while server.account_purger.purge_once():
+        pass
+
+def test_queued_score_written_after_deletion_is_dropped(load_server):
+    server = load_server(SCORE_WRITE_MODE="queue", SCORE_QUEUE_FLUSH_MS="0")
+    # Писатель забрал результат из очереди, но пишет его уже после удаления аккаунта
+    entered = threading.Event()
+    release = threading.Event()
+    insert_scores = server.insert_scores
+    def delayed_insert(*args):
+        entered.set()
+        release.wait(5)
+        return insert_scores(*args)
+
+    with TestClient(server.app) as client:
+        token = register(client, "alice")
+        user_id = server.user_repository.get_by_username("alice")["id"]
+        server.insert_scores = delayed_insert
+        assert client.post("/scores", json={"score": 42}, headers=auth(token)).status_code == 200
+        assert entered.wait(5)
+        assert client.delete("/delete-account", headers=auth(token)).status_code == 200
+        release.set()
+        server.score_writer.close()
+        server.score_writer = None
+        purge_all(server)
+
+        assert rows_left(server, user_id) == dict.fromkeys(TABLES, 0)
+        assert client.get("/scores/distribution").json()["games"]["count"] == 0
+        assert client.get("/leaderboard").json() == []
+
+def test_sync_write_after_deletion_is_refused(server, client):
+    token = register(client, "alice")
+    user_id = server.user_repository.get_by_username("alice")["id"]
+    client.post("/scores", json={"score": 10}, headers=auth(token))
+    assert client.delete("/delete-account", headers=auth(token)).status_code == 200
+
+    # Запрос прошёл проверку токена до удаления и дошёл до записи после него
+    assert server.write_scores(user_id, [(99, "2026-01-01T00:00:00+00:00")]) is False
+    purge_all(server)
+    assert rows_left(server, user_id) == dict.fromkeys(TABLES, 0)
+    # Надгробие остаётся и после окончания очистки
+    assert server.write_scores(user_id, [(99, "2026-01-01T00:00:00+00:00")]) is False
+    with server.pool.connection() as conn:
+        assert conn.execute(
+            "SELECT purged_at IS NOT NULL FROM account_purges WHERE user_id = ?", (user_id,)
+        ).fetchone() == (1,)
+
+def test_finished_purge_changes_the_etag(load_server):
+    server = load_server(PURGE_INTERVAL="3600")
+    with TestClient(server.app) as client:
+        alice, bobby = register(client, "alice"), register(client, "bobby")
+        client.post("/scores", json={"score": 10}, headers=auth(alice))
+        client.post("/scores", json={"score": 20}, headers=auth(bobby))
+        # Фоновую очистку запускает только тест
+        server.account_purger.wake = lambda: None
+        assert client.delete("/delete-account", headers=auth(alice)).status_code == 200
+
+        etag = client.get("/scores/distribution").headers["etag"]
+        assert client.get("/scores/distribution").json()["games"]["count"] == 2
+        purge_all(server)
+        response = client.get("/scores/distribution", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["games"]["count"] == 1
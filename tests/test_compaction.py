@@ -0,0 +1,113 @@
+import csv
+import glob
+import gzip
+import random
+from datetime import datetime, timedelta, timezone
+
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+USERS = ["alice", "bobby", "carol"]
+SCORES_PER_USER = 300
+
+def seed_scores(server, client):
+    # Результаты за 120 суток пишутся напрямую: /scores/batch не принимает старые отметки времени
+    rng = random.Random(7)
+    now = datetime.now(timezone.utc)
+    items = []
+    for username in USERS:
+        register(client, username)
+        user_id = server.user_repository.get_by_username(username)["id"]
+        items.extend(
+            ((now - timedelta(days=rng.uniform(0, 120))).isoformat(), user_id, rng.randint(0, 80))
+            for _ in range(SCORES_PER_USER)
+        )
+    items.sort()
+    with server.pool.connection() as conn:
+        for created_at, user_id, score in items:
+            server.insert_scores(conn.cursor(), user_id, [(score, created_at)])
+        conn.commit()
+
+def snapshot(client):
+    return (
+        client.get("/user-stats").json()["players"],
+        client.get("/scores/distribution").json(),
+        client.get("/leaderboard", params={"limit": 10}).json(),
+    )
+
+def count_rows(server, table):
+    with server.pool.connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+def test_compaction_keeps_api_results(load_server, tmp_path):
+    server = load_server()
+    with TestClient(server.app) as client:
+        seed_scores(server, client)
+
+    # Перезапуск: рейтинг и распределение строятся из записанных строк
+    with TestClient(server.app) as client:
+        before = snapshot(client)
+        total = count_rows(server, "scores")
+        compactor = server.ScoreCompactor(days=30, pause=0, archive_dir=str(tmp_path / "archive"))
+
+        compacted = compactor.compact()
+        assert compacted > 0
+        server.data_version.bump()
+        assert snapshot(client) == before
+
+        # Каждая свёрнутая строка лежит в архиве
+        remaining = count_rows(server, "scores")
+        archived = 0
+        for path in glob.glob(str(tmp_path / "archive" / "*.csv.gz")):
+            with gzip.open(path, "rt") as f:
+                archived += sum(1 for _ in csv.reader(f)) - 1
+        assert remaining == total - compacted
+        assert archived == compacted
+
+        # Следующий проход начинает с сохранённой границы и ничего не находит
+        with server.pool.connection() as conn:
+            assert conn.execute("SELECT last_id FROM compaction_progress").fetchone()[0] > 0
+        assert compactor.compact() == 0
+
+        # Агрегаты, пересчитанные с нуля, учитывают свёрнутые сутки
+        with server.pool.connection() as conn:
+            server.rebuild_aggregates(conn)
+            conn.commit()
+        server.data_version.bump()
+        assert snapshot(client)[0] == before[0]
+
+    with TestClient(server.app) as client:
+        assert snapshot(client) == before
+
+def test_deleted_account_is_purged_from_compacted_data(load_server, tmp_path):
+    server = load_server(PURGE_CHUNK_PAUSE="0")
+    with TestClient(server.app) as client:
+        seed_scores(server, client)
+
+    with TestClient(server.app) as client:
+        server.ScoreCompactor(days=30, pause=0, archive_dir=str(tmp_path / "archive")).compact()
+        token = client.post("/login", json={"username": "bobby", "password": "secret"}).json()["token"]
+        assert client.delete("/delete-account", headers=auth(token)).status_code == 200
+        # Фоновый поток уже разбужен удалением; дочищаем синхронно (транзакции не пересекаются)
+        while server.account_purger.purge_once():
+            pass
+        for table in ["scores", "score_daily", "compacted_scores"]:
+            with server.pool.connection() as conn:
+                assert conn.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id = 2").fetchone()[0] == 0
+        players = client.get("/user-stats").json()["players"]
+        assert sorted(player["username"] for player in players) == ["alice", "carol"]
+        assert client.get("/scores/distribution").json()["games"]["count"] == 2 * SCORES_PER_USER
+
+def test_fold_only_summarises_rows_already_deleted(server, client):
+    # Удаление делает _compact_chunk; _fold под блокировкой записи лишь сворачивает
+    register(client, "alice")
+    with server.pool.connection() as conn:
+        server.insert_scores(conn.cursor(), 1, [(15, "2020-01-01T10:00:00+00:00")])
+        conn.commit()
+        row = conn.execute("SELECT id, user_id, score, created_at FROM scores").fetchone()
+        server.ScoreCompactor(days=30)._fold(conn, [row])
+        conn.commit()
+        assert conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0] == 1
+        assert conn.execute("SELECT games, score_sum, best_score FROM score_daily").fetchall() == [(1, 15, 15)]
+        assert conn.execute("SELECT score, games FROM compacted_scores").fetchall() == [(15, 1)]
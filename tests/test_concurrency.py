@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import httpx
+from fastapi.testclient import TestClient
+
+from conftest import auth
+
+SLOW_STATS_SECONDS = 0.2
+SLOW_STATS_CLIENTS = 4
+SUBMISSIONS = 50
+# Без выноса запросов из цикла событий каждая отправка ждала бы медленный запрос статистики
+P99_LIMIT_SECONDS = SLOW_STATS_SECONDS / 2
+
+def p99(samples):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(0.99 * len(samples)))]
+
+def test_slow_user_stats_do_not_delay_score_submissions(load_server):
+    # Медленным клиентам статистики достаётся часть пула, отправке результатов - остальное
+    server = load_server(DB_MAX_WORKERS=SLOW_STATS_CLIENTS + 2)
+    original = server.fetch_user_stats_page
+    def slow_page(*args):
+        time.sleep(SLOW_STATS_SECONDS)
+        return original(*args)
+    server.fetch_user_stats_page = slow_page
+
+    stats_requests = 0
+
+    async def run():
+        nonlocal stats_requests
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.post("/register", json={"username": "player", "password": "secret"})
+            response = await client.post("/login", json={"username": "player", "password": "secret"})
+            token = response.json()["token"]
+
+            stop = asyncio.Event()
+            async def slow_stats():
+                nonlocal stats_requests
+                while not stop.is_set():
+                    response = await client.get("/user-stats")
+                    assert response.status_code == 200, response.text
+                    stats_requests += 1
+                    await asyncio.sleep(0)
+
+            loaders = [asyncio.create_task(slow_stats()) for _ in range(SLOW_STATS_CLIENTS)]
+            await asyncio.sleep(0.01)
+            samples = []
+            for i in range(SUBMISSIONS):
+                started = time.perf_counter()
+                # ASGITransport работает без сетевого ввода-вывода: клиенты уступают цикл явно
+                await asyncio.sleep(0)
+                response = await client.post("/scores", json={"score": i}, headers=auth(token))
+                samples.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.text
+            stop.set()
+            await asyncio.gather(*loaders)
+            return samples
+
+    server.startup()
+    try:
+        samples = asyncio.run(run())
+    finally:
+        server.shutdown()
+
+    assert stats_requests >= SLOW_STATS_CLIENTS
+    assert p99(samples) < P99_LIMIT_SECONDS, f"p99 {p99(samples) * 1000:.1f} ms"
+
+def test_slow_query_times_out_with_504(load_server):
+    server = load_server(DB_QUERY_TIMEOUT="0.05")
+    def slow_page(*args):
+        time.sleep(0.5)
+        return []
+    server.fetch_user_stats_page = slow_page
+
+    with TestClient(server.app) as client:
+        assert client.get("/user-stats").status_code == 504
+        assert client.get("/user-stats", params={"format": "ndjson"}).status_code == 504
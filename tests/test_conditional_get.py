@@ -0,0 +1,44 @@
+from conftest import auth, register
+
+def test_leaderboard_answers_304_until_a_score_changes_it(client):
+    token = register(client, "alice")
+    client.post("/scores", json={"score": 10}, headers=auth(token))
+
+    response = client.get("/leaderboard")
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "no-cache"
+    revalidated = client.get("/leaderboard", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+    assert revalidated.headers["etag"] == etag
+    assert client.get("/leaderboard", headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+
+    client.post("/scores", json={"score": 20}, headers=auth(token))
+    response = client.get("/leaderboard", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()[0]["score"] == 20
+    assert response.headers["etag"] != etag
+
+def test_window_leaderboards_have_their_own_etags(client):
+    token = register(client, "alice")
+    client.post("/scores", json={"score": 10}, headers=auth(token))
+    etags = {window: client.get("/leaderboard", params={"window": window}).headers["etag"]
+             for window in ("all", "day", "week")}
+    assert len(set(etags.values())) == 3
+    assert client.get(
+        "/leaderboard", params={"window": "day"}, headers={"If-None-Match": etags["day"]}
+    ).status_code == 304
+    assert client.get(
+        "/leaderboard", params={"window": "day"}, headers={"If-None-Match": etags["all"]}
+    ).status_code == 200
+
+def test_user_stats_etag_changes_with_account_changes(client):
+    token = register(client, "alice")
+    client.post("/scores", json={"score": 10}, headers=auth(token))
+    etag = client.get("/user-stats").headers["etag"]
+    assert client.get("/user-stats", headers={"If-None-Match": etag}).status_code == 304
+
+    assert client.delete("/delete-account", headers=auth(token)).status_code == 200
+    response = client.get("/user-stats", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["players"] == []
@@ -0,0 +1,49 @@
+from conftest import auth, register
+
+def test_percentiles_use_nearest_rank(server):
+    counts = server.ScoreCounts(max_score=100)
+    for score in range(1, 101):
+        counts.add(score)
+    summary = counts.summary([50, 90, 99, 100], 10)
+    assert summary["count"] == 100
+    assert summary["average"] == 50.5
+    assert summary["percentiles"] == {"p50": 50, "p90": 90, "p99": 99, "p100": 100}
+    assert summary["histogram"][0] == {"from": 0, "to": 9, "count": 9}
+    assert sum(bucket["count"] for bucket in summary["histogram"]) == 100
+
+def test_percentiles_after_remove_and_out_of_range(server):
+    counts = server.ScoreCounts(max_score=10)
+    for score in (1, 2, 3, 50):
+        counts.add(score)
+    counts.remove(1)
+    summary = counts.summary([50, 100], 5)
+    # Значения за границей массива попадают в последнюю ячейку, но сумма точная
+    assert summary["count"] == 3
+    assert summary["average"] == round(55 / 3, 2)
+    assert summary["percentiles"] == {"p50": 3, "p100": 10}
+
+def test_empty_distribution(server):
+    summary = server.ScoreCounts(max_score=10).summary([50], 5)
+    assert summary == {"count": 0, "average": 0, "percentiles": {"p50": None}, "histogram": []}
+
+def test_distribution_endpoint(client):
+    token = register(client, "alice")
+    for score in (10, 20, 30, 40):
+        client.post("/scores", json={"score": score}, headers=auth(token))
+    games = client.get("/scores/distribution").json()["games"]
+    assert games["count"] == 4
+    assert games["percentiles"]["p50"] == 20
+    assert games["percentiles"]["p99"] == 40
+
+def test_best_distribution_counts_each_player_once(client):
+    alice, bobby = register(client, "alice"), register(client, "bobby")
+    for score in (10, 70, 30):
+        client.post("/scores", json={"score": score}, headers=auth(alice))
+    client.post("/scores", json={"score": 40}, headers=auth(bobby))
+    best = client.get("/scores/distribution", params={"percentiles": "50,100"}).json()["best"]
+    assert best["count"] == 2
+    assert best["percentiles"] == {"p50": 40, "p100": 70}
+
+def test_invalid_percentiles_are_rejected(client):
+    for value in ("0", "101", "abc", ""):
+        assert client.get("/scores/distribution", params={"percentiles": value}).status_code == 400
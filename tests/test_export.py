@@ -0,0 +1,87 @@
+import csv
+import io
+import struct
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+def grant_admin(server, client, username):
+    token = register(client, username)
+    assert server.set_admin(username, True)
+    return token
+
+def post_scores(client, username, scores):
+    token = register(client, username)
+    for score in scores:
+        client.post("/scores", json={"score": score}, headers=auth(token))
+
+def parse_columnar(server, body):
+    assert body.startswith(server.EXPORT_MAGIC)
+    offset, rows = len(server.EXPORT_MAGIC), []
+    while offset < len(body):
+        (count,) = struct.unpack_from("<I", body, offset)
+        offset += 4
+        columns = []
+        for _ in range(3):
+            columns.append(struct.unpack_from(f"<{count}q", body, offset))
+            offset += 8 * count
+        rows.extend(zip(*columns))
+    return rows
+
+def test_export_requires_admin_flag(server, client):
+    token = register(client, "admin")
+    assert client.get("/admin/export").status_code == 401
+    # Имя "admin" само по себе прав не даёт
+    assert client.get("/admin/export", headers=auth(token)).status_code == 403
+    server.set_admin("admin", True)
+    assert client.get("/admin/export", headers=auth(token)).status_code == 200
+    server.set_admin("admin", False)
+    assert client.get("/admin/export", headers=auth(token)).status_code == 403
+
+def test_csv_and_columnar_formats(load_server):
+    server = load_server(EXPORT_CHUNK_SIZE="2")
+    with TestClient(server.app) as client:
+        post_scores(client, "alice", [10, 20, 30])
+        post_scores(client, "bobby", [5])
+        token = grant_admin(server, client, "root1")
+
+        response = client.get("/admin/export", headers=auth(token))
+        assert response.headers["content-type"].startswith("text/csv")
+        assert 'filename="scores.csv"' in response.headers["content-disposition"]
+        rows = list(csv.reader(io.StringIO(response.text)))
+        assert rows[0] == ["user_id", "username", "score", "created_at"]
+        assert [(row[1], int(row[2])) for row in rows[1:]] == [("alice", 10), ("alice", 20), ("alice", 30), ("bobby", 5)]
+
+        response = client.get("/admin/export", params={"format": "columnar"}, headers=auth(token))
+        assert response.headers["content-type"] == "application/octet-stream"
+        columnar = parse_columnar(server, response.content)
+        assert [(user_id, score) for user_id, score, _ in columnar] == [(1, 10), (1, 20), (1, 30), (2, 5)]
+        # Время игры в unix time совпадает с created_at из CSV
+        with server.pool.connection() as conn:
+            times = [t for (t,) in conn.execute("SELECT CAST(strftime('%s', created_at) AS INTEGER) FROM scores ORDER BY id")]
+        assert [t for _, _, t in columnar] == times
+
+def test_sharded_export_is_one_snapshot(load_server):
+    server = load_server(SCORE_SHARDS="3", EXPORT_CHUNK_SIZE="1")
+    with TestClient(server.app) as client:
+        for index in range(3):
+            post_scores(client, f"player{index}", [index])
+
+        export = server.export_scores("csv")
+        header = next(export)
+        # Записи и регистрации во время экспорта в него не попадают
+        post_scores(client, "player9", [99])
+        for index in range(3):
+            token = client.post("/login", json={"username": f"player{index}", "password": "secret"}).json()["token"]
+            client.post("/scores", json={"score": 50}, headers=auth(token))
+        body = (header + b"".join(export)).decode()
+
+    rows = list(csv.reader(io.StringIO(body)))[1:]
+    assert sorted((row[1], int(row[2])) for row in rows) == [("player0", 0), ("player1", 1), ("player2", 2)]
+
+def test_shard_count_is_capped(load_server):
+    server = load_server(SCORE_SHARDS=str(11))
+    with pytest.raises(RuntimeError, match="SCORE_SHARDS"):
+        server.init_database()
@@ -0,0 +1,27 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+def test_stream_subscribes_only_while_the_response_runs(server):
+    async def run():
+        response = await server.stream_leaderboard()
+        # Ответ создан, но клиент ушёл до начала передачи
+        assert len(server.leaderboard_stream._subscribers) == 0
+        del response
+
+        response = await server.stream_leaderboard()
+        body = response.body_iterator
+        snapshot = await body.__anext__()
+        assert "event: snapshot" in snapshot
+        assert len(server.leaderboard_stream._subscribers) == 1
+
+        server.leaderboard.record(1, "alice", 42)
+        server.leaderboard_stream.notify()
+        diff = await body.__anext__()
+        assert "event: diff" in diff and '"username": "alice"' in diff
+
+        await body.aclose()
+        assert len(server.leaderboard_stream._subscribers) == 0
+
+    with TestClient(server.app):
+        asyncio.run(run())
@@ -0,0 +1,92 @@
+import hashlib
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import auth
+
+def create_legacy_database(path):
+    # Схема до появления миграций: пароли - sha256 без соли, агрегатов нет
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE scores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+    ''')
+    conn.execute(
+        "INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)",
+        ("oldtimer", hashlib.sha256(b"legacy").hexdigest(), "2024-01-01T00:00:00"),
+    )
+    conn.executemany(
+        "INSERT INTO scores (user_id, score, created_at) VALUES (1, ?, ?)",
+        [(7, "2024-01-02T00:00:00"), (12, "2024-01-03T00:00:00")],
+    )
+    conn.commit()
+    conn.close()
+
+def test_legacy_database_is_migrated(load_server, tmp_path):
+    create_legacy_database(tmp_path / "test.db")
+    server = load_server()
+    with TestClient(server.app) as client:
+        with server.pool.connection() as conn:
+            assert server.schema_version(conn) == len(server.MIGRATIONS)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+            assert "token_generation" in columns and "is_admin" in columns
+
+        # Агрегаты заполнены из существующих результатов
+        players = client.get("/user-stats").json()["players"]
+        assert players == [{
+            "username": "oldtimer",
+            "games_played": 2,
+            "best_score": 12,
+            "average_score": 9.5,
+            "last_scores": [12, 7],
+        }]
+        assert client.get("/leaderboard").json()[0]["username"] == "oldtimer"
+
+        # Старый пароль принимается и перехэшируется при входе
+        response = client.post("/login", json={"username": "oldtimer", "password": "legacy"})
+        assert response.status_code == 200, response.text
+        assert client.get("/me", headers=auth(response.json()["token"])).status_code == 200
+        with server.pool.connection() as conn:
+            hashed = conn.execute("SELECT password FROM users WHERE username = 'oldtimer'").fetchone()[0]
+        assert not server.password_needs_rehash(hashed)
+
+def test_migrate_is_idempotent(server):
+    server.init_database()
+    try:
+        with server.pool.connection() as conn:
+            assert server.migrate(conn) == 0
+            versions = [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+        assert versions == list(range(1, len(server.MIGRATIONS) + 1))
+    finally:
+        server.shutdown()
+
+def test_failed_step_is_rolled_back_and_retried(server, tmp_path, monkeypatch):
+    conn = sqlite3.connect(tmp_path / "partial.db")
+    def broken(c):
+        c.execute("CREATE TABLE half_done (id INTEGER)")
+        raise sqlite3.OperationalError("disk full")
+    monkeypatch.setattr(server, "MIGRATIONS", server.MIGRATIONS[:2] + [broken])
+
+    with pytest.raises(sqlite3.OperationalError):
+        server.migrate(conn)
+    # Первые шаги применены, сломанный - откатился целиком
+    assert server.schema_version(conn) == 2
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+
+    monkeypatch.setattr(server, "MIGRATIONS", server.MIGRATIONS[:2] + [lambda c: None])
+    assert server.migrate(conn) == 1
+    assert server.schema_version(conn) == 3
+    conn.close()
@@ -0,0 +1,41 @@
+from conftest import auth, register
+
+BEST = {"alice": 50, "bobby": 30, "carol": 30, "dave1": 10}
+
+def setup_players(client):
+    tokens = {}
+    for username, best in BEST.items():
+        tokens[username] = register(client, username)
+        client.post("/scores", json={"score": best}, headers=auth(tokens[username]))
+    return tokens
+
+def test_rank_with_ties_and_neighbours(client):
+    setup_players(client)
+    rank = client.get("/rank/carol", params={"neighbours": 1}).json()
+    assert rank["username"] == "carol" and rank["score"] == 30
+    # bobby и carol делят второе место; позиция - по порядку регистрации
+    assert (rank["position"], rank["rank"], rank["players"]) == (3, 2, 4)
+    assert rank["percentile"] == 25.0
+    assert rank["above"] == [{"position": 2, "username": "bobby", "score": 30}]
+    assert rank["below"] == [{"position": 4, "username": "dave1", "score": 10}]
+
+    top = client.get("/rank/alice", params={"neighbours": 2}).json()
+    assert (top["rank"], top["percentile"], top["above"]) == (1, 75.0, [])
+    assert [row["username"] for row in top["below"]] == ["bobby", "carol"]
+
+def test_rank_me_follows_new_best(client):
+    tokens = setup_players(client)
+    client.post("/scores", json={"score": 60}, headers=auth(tokens["dave1"]))
+    client.post("/scores", json={"score": 5}, headers=auth(tokens["alice"]))
+    rank = client.get("/rank/me", params={"neighbours": 0}, headers=auth(tokens["dave1"])).json()
+    assert (rank["score"], rank["position"], rank["percentile"]) == (60, 1, 75.0)
+    assert rank["above"] == rank["below"] == []
+    assert client.get("/rank/alice").json()["position"] == 2
+
+def test_rank_errors(client):
+    token = register(client, "nobody")
+    assert client.get("/rank/ghost").status_code == 404
+    assert client.get("/rank/nobody").status_code == 404
+    assert client.get("/rank/me", headers=auth(token)).status_code == 404
+    assert client.get("/rank/me").status_code == 401
+    assert client.get("/rank/nobody", params={"neighbours": 11}).status_code == 422
@@ -0,0 +1,70 @@
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_burst_then_refill(server, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    limiter = server.RateLimiter({"/scores": (2, 3)})
+
+    assert [limiter.check("/scores", 1) for _ in range(3)] == [0, 0, 0]
+    assert limiter.check("/scores", 1) == 0.5
+    # Другой пользователь расходует свою корзину
+    assert limiter.check("/scores", 2) == 0
+
+    clock.now += 0.5
+    assert limiter.check("/scores", 1) == 0
+    assert limiter.check("/scores", 1) > 0
+
+    # Корзина не наполняется выше размера всплеска
+    clock.now += 60
+    assert [limiter.check("/scores", 1) for _ in range(4)][-1] > 0
+
+def test_cost_and_disabled_route(server):
+    limiter = server.RateLimiter({"/scores/batch": (1, 5), "/scores": (0, 1)})
+    assert limiter.check("/scores/batch", 1, cost=5) == 0
+    assert limiter.check("/scores/batch", 1, cost=2) > 0
+    assert all(limiter.check("/scores", 1) == 0 for _ in range(100))
+
+def test_least_recently_used_bucket_is_evicted(server, monkeypatch):
+    monkeypatch.setattr(server.time, "monotonic", FakeClock())
+    limiter = server.RateLimiter({"/scores": (1, 1)}, max_buckets=2)
+    limiter.check("/scores", 1)
+    limiter.check("/scores", 2)
+    limiter.check("/scores", 1)
+    limiter.check("/scores", 3)
+    assert len(limiter) == 2
+    # Вытеснена давно не использованная корзина 2: она начинается заново полной,
+    # а корзина 3 осталась пустой
+    assert limiter.check("/scores", 2) == 0
+    assert limiter.check("/scores", 3) > 0
+
+def test_scores_endpoint_returns_429(load_server):
+    server = load_server(RATE_LIMIT_SCORES_RATE="0.5", RATE_LIMIT_SCORES_BURST="2")
+    with TestClient(server.app) as client:
+        token = register(client, "alice")
+        statuses = [client.post("/scores", json={"score": 1}, headers=auth(token)).status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        response = client.post("/scores", json={"score": 1}, headers=auth(token))
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+
+def test_batch_route_has_its_own_bucket(load_server):
+    server = load_server(
+        RATE_LIMIT_SCORES_RATE="0.5", RATE_LIMIT_SCORES_BURST="1",
+        RATE_LIMIT_SCORES_BATCH_RATE="0.5", RATE_LIMIT_SCORES_BATCH_BURST="1",
+    )
+    with TestClient(server.app) as client:
+        alice, bobby = register(client, "alice"), register(client, "bobby")
+        assert client.post("/scores", json={"score": 1}, headers=auth(alice)).status_code == 200
+        # Исчерпанная корзина /scores не мешает пакетам и другим игрокам
+        assert client.post("/scores/batch", json=[{"score": 1}], headers=auth(alice)).status_code == 200
+        assert client.post("/scores/batch", json=[{"score": 1}], headers=auth(alice)).status_code == 429
+        assert client.post("/scores", json={"score": 1}, headers=auth(bobby)).status_code == 200
@@ -0,0 +1,57 @@
+import sqlite3
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+def test_queued_scores_are_group_committed(load_server):
+    server = load_server(SCORE_WRITE_MODE="queue", SCORE_QUEUE_FLUSH_MS="20")
+    with TestClient(server.app) as client:
+        token = register(client, "alice")
+        for score in range(1, 21):
+            response = client.post("/scores", json={"score": score}, headers=auth(token))
+            assert response.json() == {"success": True, "queued": True}
+
+        wait_for(lambda: client.get("/scores/queue").json()["rows_committed"] == 20)
+        metrics = client.get("/scores/queue").json()
+        assert metrics["enabled"] and metrics["queue_depth"] == 0
+        assert metrics["batches_committed"] <= 20
+        players = client.get("/user-stats").json()["players"]
+        assert players[0]["games_played"] == 20
+        assert players[0]["last_scores"] == [20, 19, 18, 17, 16]
+        assert client.get("/leaderboard").json()[0]["score"] == 20
+
+def test_full_queue_answers_503_and_shutdown_drains_it(load_server):
+    server = load_server(SCORE_WRITE_MODE="queue", SCORE_QUEUE_SIZE="1", SCORE_QUEUE_FLUSH_MS="0")
+    # Писатель застревает на первой пачке, пока тест его не отпустит
+    entered = threading.Event()
+    release = threading.Event()
+    insert_scores = server.insert_scores
+    def blocking_insert(*args):
+        entered.set()
+        release.wait(5)
+        return insert_scores(*args)
+    server.insert_scores = blocking_insert
+
+    with TestClient(server.app) as client:
+        token = register(client, "alice")
+        assert client.post("/scores", json={"score": 1}, headers=auth(token)).status_code == 200
+        assert entered.wait(5)
+        assert client.post("/scores", json={"score": 2}, headers=auth(token)).status_code == 200
+
+        response = client.post("/scores", json={"score": 3}, headers=auth(token))
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        release.set()
+
+    # Остановка дописывает всё, что было принято в очередь
+    with sqlite3.connect(server.DATABASE_FILE) as conn:
+        assert conn.execute("SELECT score FROM scores ORDER BY id").fetchall() == [(1,), (2,)]
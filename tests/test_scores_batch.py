@@ -0,0 +1,48 @@
+import time
+
+from conftest import auth, register
+
+def test_batch_reports_status_per_item(client):
+    token = register(client, "alice")
+    now = int(time.time())
+    response = client.post("/scores/batch", headers=auth(token), json=[
+        {"score": 10, "timestamp": now - 60},
+        {"score": "high"},
+        "not an object",
+        {"score": 20, "timestamp": now - 30 * 24 * 3600},
+        {"score": 30},
+    ])
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body["success"] is False
+    assert (body["accepted"], body["rejected"]) == (2, 3)
+    assert [item["status"] for item in body["results"]] == ["ok", "error", "error", "error", "ok"]
+    assert [item["index"] for item in body["results"]] == [0, 1, 2, 3, 4]
+    assert all(item["detail"] for item in body["results"] if item["status"] == "error")
+
+    players = client.get("/user-stats").json()["players"]
+    assert players[0]["games_played"] == 2
+    assert players[0]["last_scores"] == [30, 10]
+
+def test_batch_limit_and_empty_batch(client):
+    token = register(client, "alice")
+    assert client.post("/scores/batch", headers=auth(token), json=[{"score": 1}] * 1001).status_code == 413
+    body = client.post("/scores/batch", headers=auth(token), json=[]).json()
+    assert (body["success"], body["accepted"], body["rejected"]) == (True, 0, 0)
+
+def test_backdated_batch_item_keeps_last_scores_in_time_order(server, client):
+    token = register(client, "alice")
+    for score in (10, 20):
+        client.post("/scores", json={"score": score}, headers=auth(token))
+    client.post("/scores/batch", headers=auth(token), json=[{"score": 99, "timestamp": int(time.time()) - 3 * 24 * 3600}])
+
+    players = client.get("/user-stats").json()["players"]
+    assert players[0]["last_scores"] == [20, 10, 99]
+    assert players[0]["best_score"] == 99
+
+    # Совпадает с пересчётом агрегатов с нуля
+    with server.pool.connection() as conn:
+        before = conn.execute("SELECT * FROM user_aggregates").fetchall()
+        server.rebuild_aggregates(conn)
+        conn.commit()
+        assert conn.execute("SELECT * FROM user_aggregates").fetchall() == before
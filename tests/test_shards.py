@@ -0,0 +1,82 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+USERS = ["alice", "bobby", "carol", "dave1", "erin1"]
+
+def post_scores(client):
+    for index, username in enumerate(USERS):
+        token = register(client, username)
+        for score in (index * 10, index * 10 + 5):
+            assert client.post("/scores", json={"score": score}, headers=auth(token)).status_code == 200
+
+def snapshot(client):
+    return (
+        client.get("/user-stats").json()["players"],
+        client.get("/leaderboard", params={"limit": 10}).json(),
+        client.get("/scores/distribution").json()["games"],
+    )
+
+def shard_users(server):
+    users = []
+    for shard in server.shard_pools:
+        with shard.connection() as conn:
+            users.append({user_id for (user_id,) in conn.execute("SELECT DISTINCT user_id FROM scores")})
+    return users
+
+def test_scores_are_routed_by_user_id(load_server):
+    server = load_server(SCORE_SHARDS="3")
+    with TestClient(server.app) as client:
+        post_scores(client)
+        players = client.get("/user-stats", params={"limit": 2}).json()
+        rest = client.get("/user-stats", params={"cursor": players["next_cursor"]}).json()["players"]
+        assert [p["username"] for p in players["players"] + rest] == USERS[::-1]
+
+        for index, users in enumerate(shard_users(server)):
+            assert users and all(user_id % 3 == index for user_id in users)
+        with server.pool.connection() as conn:
+            assert not server.main_has_scores(conn)
+
+def test_reshard_can_be_rerun_after_a_crash(load_server):
+    server = load_server()
+    with TestClient(server.app) as client:
+        post_scores(client)
+        before = snapshot(client)
+
+    # Без переноса сервер с шардами не запускается
+    server = load_server(SCORE_SHARDS="3")
+    with pytest.raises(RuntimeError, match="reshard"):
+        server.init_database()
+
+    # Перенос падает на втором шарде
+    server.init_database(resharding=True)
+    rebuild = server.rebuild_aggregates
+    calls = []
+    def failing_rebuild(conn):
+        calls.append(conn)
+        if len(calls) == 2:
+            raise OSError("disk full")
+        return rebuild(conn)
+    server.rebuild_aggregates = failing_rebuild
+    with pytest.raises(OSError):
+        server.reshard()
+    server.shutdown()
+
+    # Незаконченный перенос не даёт запуститься ни с новым, ни со старым числом шардов
+    for shards in ("3", "1"):
+        with pytest.raises(RuntimeError):
+            load_server(SCORE_SHARDS=shards).init_database()
+
+    server = load_server(SCORE_SHARDS="3")
+    server.init_database(resharding=True)
+    server.reshard()
+    assert server.reshard() == 0
+    server.shutdown()
+
+    server = load_server(SCORE_SHARDS="3")
+    with TestClient(server.app) as client:
+        assert snapshot(client) == before
+        assert sum(len(users) for users in shard_users(server)) == len(USERS)
+        with server.pool.connection() as conn:
+            assert not server.main_has_scores(conn)
@@ -0,0 +1,46 @@
+from conftest import auth, register
+
+def change_password(client, token, current, new):
+    return client.patch(
+        "/change-password", headers=auth(token),
+        json={"current_password": current, "new_password": new},
+    )
+
+def test_password_change_revokes_earlier_tokens(client):
+    old_token = register(client, "alice")
+    other_session = client.post("/login", json={"username": "alice", "password": "secret"}).json()["token"]
+    # Токен уже проверен и лежит в кэше
+    assert client.get("/me", headers=auth(old_token)).status_code == 200
+
+    response = change_password(client, old_token, "secret", "better")
+    assert response.status_code == 200, response.text
+    new_token = response.json()["token"]
+
+    for token in (old_token, other_session):
+        assert client.get("/me", headers=auth(token)).status_code == 401
+        assert client.post("/scores", json={"score": 1}, headers=auth(token)).status_code == 401
+    assert client.get("/me", headers=auth(new_token)).json()["username"] == "alice"
+    assert client.post("/login", json={"username": "alice", "password": "secret"}).status_code == 401
+    assert client.post("/login", json={"username": "alice", "password": "better"}).status_code == 200
+
+def test_wrong_current_password_keeps_tokens(client):
+    token = register(client, "alice")
+    assert change_password(client, token, "wrong", "better").status_code == 400
+    assert client.get("/me", headers=auth(token)).status_code == 200
+
+def test_account_deletion_revokes_tokens(client):
+    token = register(client, "alice")
+    assert client.get("/me", headers=auth(token)).status_code == 200
+    assert client.delete("/delete-account", headers=auth(token)).status_code == 200
+
+    assert client.get("/me", headers=auth(token)).status_code == 401
+    assert client.post("/scores", json={"score": 1}, headers=auth(token)).status_code == 401
+    # Имя освободилось, но старый токен к новому аккаунту не подходит
+    new_token = register(client, "alice")
+    assert client.get("/me", headers=auth(token)).status_code == 401
+    assert client.get("/me", headers=auth(new_token)).status_code == 200
+
+def test_malformed_tokens_are_rejected(client):
+    assert client.get("/me").status_code == 401
+    assert client.get("/me", headers={"Authorization": "Token abc"}).status_code == 401
+    assert client.get("/me", headers=auth("not.a.jwt")).status_code == 401
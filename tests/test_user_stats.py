@@ -0,0 +1,78 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+BEST_SCORES = {"alice": 30, "bobby": 50, "carol": 30, "dave1": 10, "erin1": 50}
+
+@pytest.fixture
+def stats_client(load_server):
+    # Маленькая порция, чтобы NDJSON читался в несколько заходов
+    server = load_server(USER_STATS_PAGE_SIZE="2")
+    with TestClient(server.app) as client:
+        for username, best in BEST_SCORES.items():
+            token = register(client, username)
+            for score in (best - 5, best):
+                assert client.post("/scores", json={"score": score}, headers=auth(token)).status_code == 200
+        yield client
+
+def expected_order():
+    # best_score по убыванию, при равенстве - в порядке регистрации
+    names = list(BEST_SCORES)
+    return sorted(names, key=lambda name: (-BEST_SCORES[name], names.index(name)))
+
+def test_cursor_pagination_walks_every_player_once(stats_client):
+    seen = []
+    params = {"limit": 2}
+    while True:
+        page = stats_client.get("/user-stats", params=params).json()
+        seen.extend(player["username"] for player in page["players"])
+        if page["next_cursor"] is None:
+            break
+        params["cursor"] = page["next_cursor"]
+    assert seen == expected_order()
+
+def test_player_stats_fields(stats_client):
+    players = stats_client.get("/user-stats", params={"limit": 1}).json()["players"]
+    assert players == [{
+        "username": "bobby",
+        "games_played": 2,
+        "best_score": 50,
+        "average_score": 47.5,
+        "last_scores": [50, 45],
+    }]
+
+def test_invalid_cursor_is_rejected(stats_client):
+    assert stats_client.get("/user-stats", params={"cursor": "not-a-cursor"}).status_code == 400
+
+def test_ndjson_matches_json(stats_client):
+    players = stats_client.get("/user-stats", params={"limit": 1000}).json()["players"]
+    response = stats_client.get("/user-stats", params={"format": "ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line) for line in response.text.splitlines()] == players
+
+    response = stats_client.get("/user-stats", params={"format": "ndjson", "limit": 3})
+    assert [json.loads(line)["username"] for line in response.text.splitlines()] == expected_order()[:3]
+
+def test_etag_revalidation(stats_client):
+    etag = stats_client.get("/user-stats").headers["etag"]
+    assert stats_client.get("/user-stats", headers={"If-None-Match": etag}).status_code == 304
+
+def test_deep_cursor_seeks_the_index(server, client):
+    # Страница после курсора должна искать по индексу, а не просматривать его сверху
+    for select, join in [
+        ("a.user_id, u.username", "JOIN users u ON a.user_id = u.id"),
+        ("a.user_id, a.best_score", ""),
+    ]:
+        query, params = server.stats_page_query(select, join, (5, 1000), 100)
+        with server.pool.connection() as conn:
+            plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params))
+        assert "SEARCH a USING" in plan and "idx_user_aggregates_best (best_score<?)" in plan, plan
+
+def test_cursor_inside_a_tie(stats_client):
+    # Курсор на первом из двух игроков с одинаковым результатом продолжает со второго
+    first = stats_client.get("/user-stats", params={"limit": 1}).json()
+    rest = stats_client.get("/user-stats", params={"limit": 1000, "cursor": first["next_cursor"]}).json()
+    assert [player["username"] for player in rest["players"]] == expected_order()[1:]
@@ -0,0 +1,51 @@
+import time
+from datetime import datetime, timezone
+
+from conftest import auth, register
+
+DAY = 24 * 3600
+
+def test_bucket_boundaries(server):
+    assert server.day_bucket("1970-01-02T00:00:00") == 1
+    assert server.day_bucket("1970-01-01T23:59:59+00:00") == 0
+    # Время с часовым поясом переводится в UTC
+    assert server.day_bucket("1970-01-02T01:00:00+03:00") == 0
+    # 1970-01-04 - воскресенье, 1970-01-05 - понедельник, начало следующей недели
+    assert server.window_bucket("week", 3) == 0
+    assert server.window_bucket("week", 4) == 1
+    assert server.window_bucket("week", 10) == 1
+    assert server.window_bucket("week", 11) == 2
+    assert server.window_bucket("day", 11) == 11
+
+def test_window_leaderboards_keep_only_their_bucket(server, client):
+    now = int(time.time())
+    alice, bobby = register(client, "alice"), register(client, "bobby")
+    client.post("/scores/batch", headers=auth(alice), json=[{"score": 90, "timestamp": now - 2 * DAY}, {"score": 10}])
+    client.post("/scores/batch", headers=auth(bobby), json=[{"score": 50, "timestamp": now - 6 * DAY}, {"score": 20}])
+
+    def board(window):
+        return [(row["username"], row["score"])
+                for row in client.get("/leaderboard", params={"window": window, "limit": 10}).json()]
+
+    assert board("all") == [("alice", 90), ("bobby", 50)]
+    assert board("day") == [("bobby", 20), ("alice", 10)]
+
+    # Старые результаты попадают в недельный топ, только если это та же неделя
+    def this_week(days_ago):
+        day = server.day_bucket(datetime.fromtimestamp(now - days_ago * DAY, timezone.utc).isoformat())
+        return server.window_bucket("week", day) == server.current_bucket("week")
+    expected = sorted(
+        [("alice", 90 if this_week(2) else 10), ("bobby", 50 if this_week(6) else 20)],
+        key=lambda row: -row[1],
+    )
+    assert board("week") == expected
+
+def test_deleted_player_leaves_window_leaderboards(client):
+    alice, bobby = register(client, "alice"), register(client, "bobby")
+    client.post("/scores", json={"score": 30}, headers=auth(alice))
+    client.post("/scores", json={"score": 20}, headers=auth(bobby))
+    assert client.delete("/delete-account", headers=auth(alice)).status_code == 200
+    for window in ("day", "week"):
+        rows = client.get("/leaderboard", params={"window": window}).json()
+        assert [row["username"] for row in rows] == ["bobby"]
+        assert rows[0]["position"] == 1
@@ -0,0 +1,56 @@
+import hashlib
+import time
+from contextlib import ExitStack
+
+from fastapi.testclient import TestClient
+
+from conftest import auth, register
+
+WORKER_ENV = {"SERVER_WORKERS": "2", "CACHE_SYNC_INTERVAL": "0.01"}
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+def start_worker(load_server, stack, worker=None):
+    # Два модуля сервера в одном процессе: события различаются по номеру процесса,
+    # поэтому второму назначается свой, иначе он примет чужие события за свои
+    server = load_server(**WORKER_ENV)
+    client = stack.enter_context(TestClient(server.app))
+    if worker is not None:
+        server.cache_sync._worker = worker
+    return server, client
+
+def test_login_rehash_reaches_other_workers(load_server):
+    with ExitStack() as stack:
+        worker_a, client_a = start_worker(load_server, stack)
+        token = register(client_a, "alice", "legacy")
+        with worker_a.pool.connection() as conn:
+            conn.execute("UPDATE users SET password = ? WHERE username = 'alice'",
+                         (hashlib.sha256(b"legacy").hexdigest(),))
+            conn.commit()
+        worker_a.user_repository.clear()
+
+        worker_b, client_b = start_worker(load_server, stack, worker=-1)
+        # Второй процесс уже держит в кэше старый хэш
+        assert worker_b.password_needs_rehash(worker_b.user_repository.get_by_username("alice")["password"])
+
+        applied = worker_b.cache_sync.events_applied
+        response = client_a.post("/login", json={"username": "alice", "password": "legacy"})
+        assert response.status_code == 200
+        with worker_a.pool.connection() as conn:
+            assert conn.execute(
+                "SELECT kind FROM cache_events WHERE user_id = 1 ORDER BY id DESC LIMIT 1"
+            ).fetchone() == ("password",)
+        wait_for(lambda: worker_b.cache_sync.events_applied > applied)
+
+        # Токены, выданные до перехэширования, остаются действительными
+        assert client_b.get("/me", headers=auth(token)).status_code == 200
+        assert not worker_b.password_needs_rehash(worker_b.user_repository.get_by_username("alice")["password"])
+        response = client_b.patch(
+            "/change-password", headers=auth(token),
+            json={"current_password": "legacy", "new_password": "better"},
+        )
+        assert response.status_code == 200, response.text